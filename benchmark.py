@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# benchmark.py
+#
+# Benchmarks MCVCM on synthetic data, no survey data needed.
+#
+# For each size, writes an infrared mosaic and a (1,1,n,m) radio continuum
+# and rms map with valid WCS, an ATLAS-like radio catalogue and a
+# SWIRE-like infrared catalogue, then times the stages of a session:
+# one-off and engine cutouts, catalogue loading (cold, parsing the files,
+# and warm, from the binary caches), neighbourhood queries,
+# recovering a saved session (check_save) and saving it (update_table).
+#
+# Results are written to output/benchmarks/ as .json and .csv, e.g.:
+#
+#   >> benchmark.py --sizes small medium --repeat 20
+#   >> benchmark.py --compare output/benchmarks/benchmark_<date>.json
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import matplotlib
+
+matplotlib.use("Agg")  # no window
+
+import numpy as np
+
+from utilities import make_folder, read_config, Timings
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+# infrared mosaic side (pixels), radio sources, infrared sources
+sizes = {'small': (2000, 1000, 20000),
+         'medium': (6000, 5000, 200000),
+         'large': (15000, 20000, 1000000)}
+
+centre = (53.0, -28.0)  # deg
+infrared_scale = 0.6  # arcsec/pixel
+radio_scale = 1.5
+
+
+def celestial_header(side, scale, naxis=2):
+    from astropy.wcs import WCS
+
+    w = WCS(naxis=naxis)
+    w.wcs.ctype = ['RA---SIN', 'DEC--SIN', 'FREQ', 'STOKES'][:naxis]
+    w.wcs.crval = [centre[0], centre[1], 1.4e9, 1][:naxis]
+    w.wcs.crpix = [side / 2, side / 2, 1, 1][:naxis]
+    w.wcs.cdelt = [-scale / 3600, scale / 3600, 1e6, 1][:naxis]
+    return w.to_header()
+
+
+def write_mosaic(path, shape, header, rng, low=0., high=1.):
+    '''
+        Writes a float32 image of shape in row blocks, so
+        the large sizes never need to fit in memory
+    '''
+    from astropy.io import fits
+
+    header = header.copy()
+    hdu = fits.PrimaryHDU(data=np.zeros((1,) * len(shape), dtype=np.float32), header=header)
+    header = hdu.header
+    header['NAXIS'] = len(shape)
+    for axis, length in enumerate(reversed(shape), 1):
+        header[f'NAXIS{axis}'] = length
+    header.tofile(path, overwrite=True)
+
+    ny, nx = shape[-2:]
+    with open(path, 'ab') as f:
+        for y0 in range(0, ny, 1024):
+            rows = min(1024, ny - y0)
+            f.write((low + (high - low) * rng.random((rows, nx))).astype('>f4').tobytes())
+        f.write(b'\0' * (-(ny * nx * 4) % 2880))  # pad to a whole FITS block
+
+
+def field_files(directory):
+    '''
+        Paths of a synthetic field in directory, with the keys of path_config.json
+    '''
+    return {key: os.path.join(directory, name) for key, name in
+            (('infrared_mosaic', 'infrared.fits'), ('radio_continuum', 'radio.fits'), ('radio_rms', 'rms.fits'),
+             ('radio_catalog', 'radio.dat'), ('infrared_catalog', 'infrared_catalogue.fits'))}
+
+
+def make_field(directory, side, n_radio, n_infrared, seed=1):
+    '''
+        Writes a synthetic field to directory, returns its paths
+        (same keys as path_config.json)
+    '''
+    from astropy.io import ascii
+    from astropy.table import Table
+
+    rng = np.random.default_rng(seed)
+    paths = field_files(directory)
+
+    rside = int(side * infrared_scale / radio_scale)
+    write_mosaic(paths['infrared_mosaic'], (side, side), celestial_header(side, infrared_scale), rng)
+    write_mosaic(paths['radio_continuum'], (1, 1, rside, rside), celestial_header(rside, radio_scale, 4), rng)
+    write_mosaic(paths['radio_rms'], (1, 1, rside, rside), celestial_header(rside, radio_scale, 4), rng,
+                 low=1e-5, high=2e-5)
+
+    # sources uniformly over the inner 90% of the mosaic
+    half = 0.45 * side * infrared_scale / 3600
+
+    def positions(n):
+        dec = centre[1] + rng.uniform(-half, half, n)
+        return centre[0] + rng.uniform(-half, half, n) / np.cos(np.radians(dec)), dec
+
+    ra, dec = positions(n_radio)
+    ascii.write(Table({'ID': [f'EI{i:05d}' for i in range(n_radio)], 'RA_deg': ra, 'Dec_deg': dec,
+                       'Sint': rng.lognormal(0, 1, n_radio)}),
+                paths['radio_catalog'], format='fixed_width_two_line', overwrite=True)
+    ra, dec = positions(n_infrared)
+    Table({'object': np.char.add('SWIRE3_J', np.char.zfill(np.arange(n_infrared).astype(str), 7)),
+           'ra': ra, 'dec': dec, 'flux_ap2_36': rng.lognormal(3, 1, n_infrared)}).write(
+        paths['infrared_catalog'], format='fits', overwrite=True)
+    return paths
+
+
+def clear_caches(paths):
+    '''
+        Removes the catalogue caches of a synthetic field,
+        so the next load parses the catalogues
+    '''
+    import catalogue
+
+    for path in catalogue.cache_paths(paths['radio_catalog']) + catalogue.column_paths(paths['infrared_catalog']):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.isfile(path):
+            os.remove(path)
+
+
+def run_size(name, paths, repeat, parameter_config, timings):
+    '''
+        Times each stage repeat times on one synthetic field,
+        stage names are prefixed with the size name
+    '''
+    import matplotlib.pyplot as plt
+    from astropy.io import ascii
+    import catalogue
+    import cutout
+    import session
+    from identity import CrossMatch
+
+    isize = parameter_config['cutout_pixels']['infrared']
+    rsize = parameter_config['cutout_pixels']['radio']
+    radius = parameter_config['neighbour_radius_arcsec']
+
+    # as mcvcm.py loads them: parsed and cached on first use, then from the cache
+    for _ in range(repeat):
+        clear_caches(paths)
+        with timings(f'{name}: radio catalogue load (cold)'):
+            catalogue.load_radio(paths['radio_catalog'], 'RA_deg', 'Dec_deg')
+        with timings(f'{name}: infrared catalogue load (cold)'):
+            catalogue.load_infrared(paths['infrared_catalog'], ['object', 'ra', 'dec'], 'ra', 'dec')
+        with timings(f'{name}: radio catalogue load (warm)'):
+            rTable, rXYZ = catalogue.load_radio(paths['radio_catalog'], 'RA_deg', 'Dec_deg')
+        with timings(f'{name}: infrared catalogue load (warm)'):
+            iTable, iXYZ = catalogue.load_infrared(paths['infrared_catalog'], ['object', 'ra', 'dec'], 'ra', 'dec')
+
+    with timings(f'{name}: spatial index build'):
+        iIndex = catalogue.SkyIndex(None, None, xyz=iXYZ)
+
+    rng = np.random.default_rng(2)
+    targets = rng.choice(len(rTable), size=repeat)
+    for row in targets:
+        with timings(f'{name}: neighbourhood query'):
+            iIndex.query(rTable['RA_deg'][row], rTable['Dec_deg'][row], radius)
+
+    # cutouts, one-off (opens the mosaics each time) and from an open engine
+    for row in targets:
+        with timings(f'{name}: cutouts2 (one-off)'):
+            fig, ax, axtrans, wcsmap = cutout.cutouts2(paths['infrared_mosaic'], paths['radio_continuum'],
+                                                       paths['radio_rms'], rTable['RA_deg'][row],
+                                                       rTable['Dec_deg'][row], isize=isize, rsize=rsize)
+        plt.close(fig)
+    engine = cutout.CutoutEngine(paths['infrared_mosaic'], paths['radio_continuum'], paths['radio_rms'],
+                                 rms_window=rsize)
+    for row in targets:
+        with timings(f'{name}: engine prepare'):
+            cut = engine.prepare(rTable['RA_deg'][row], rTable['Dec_deg'][row], isize=isize, rsize=rsize)
+        with timings(f'{name}: engine plot'):
+            fig = engine.plot(cut)[0]
+        plt.close(fig)
+    engine.close()
+
+    # a session with every other source tagged, saved and then recovered
+    tagged = np.arange(0, len(rTable), 2)
+    xmatch = CrossMatch(rTable['ID'], iTable['object'])
+    xmatch.set(tagged, tagged, tagged, 1, 0, 1)
+    save_path = os.path.join(os.path.dirname(paths['radio_catalog']), 'mcvcm_table.dat')
+    journal = session.Journal(os.path.splitext(save_path)[0] + '.journal')
+    records = session.table_records(xmatch, tagged)
+    for _ in range(repeat):
+        with timings(f'{name}: update_table (write)'):
+            session.write_table(session.xid_table(rTable, xmatch), save_path)
+        with timings(f'{name}: update_table (compact)'):
+            journal.compact(records)
+
+    for _ in range(repeat):
+        recovered = CrossMatch(rTable['ID'], iTable['object'])
+        with timings(f'{name}: check_save (table)'):
+            session.merge_saved(recovered, ascii.read(save_path), 'ID')
+        recovered = CrossMatch(rTable['ID'], iTable['object'])
+        with timings(f'{name}: check_save (journal)'):
+            session.apply_records(recovered, journal.replay())
+    journal.close()
+
+
+def import_profile(top=10):
+    '''
+        Start-up cost of the command line and of the session modules, from
+        fresh interpreters: wall time of 'mcvcm.py -h', and python -X importtime
+        of the modules mcvcm.py imports once the arguments are valid
+    '''
+    import subprocess
+    import sys
+
+    profile = {}
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(thisdir, 'mcvcm.py'), '-h'], stdout=subprocess.DEVNULL, check=True)
+    profile['mcvcm -h'] = time.perf_counter() - start
+
+    modules = 'matplotlib.pyplot, numpy, astropy.io.ascii, astropy.table, catalogue, cutout, session, identity'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {modules}'], cwd=thisdir,
+                            env=dict(os.environ, MPLBACKEND='Agg'), stderr=subprocess.PIPE, text=True, check=True)
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, total, name = line[len('import time:'):].split('|')
+            if total.strip().isdigit() and not name.startswith('  '):  # top level imports only
+                cumulative[name.strip()] = int(total) / 1e6
+    profile['session imports'] = sum(cumulative.values())
+    profile['slowest imports'] = dict(sorted(cumulative.items(), key=lambda item: -item[1])[:top])
+    return profile
+
+
+def compare(summary, baseline_path, threshold=1.2):
+    '''
+        Prints the p50 ratio to a previous run for stages in both,
+        marking those slower than threshold times the baseline
+    '''
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)['stages']
+    print(f'\n{"stage":<40}{"baseline ms":>12}{"now ms":>10}{"ratio":>8}')
+    for name in sorted(set(summary) & set(baseline)):
+        old, new = baseline[name]['p50'], summary[name]['p50']
+        ratio = new / old if old > 0 else np.inf
+        flag = '  <-- slower' if ratio > threshold else ''
+        print(f'{name:<40}{1e3 * old:>12.2f}{1e3 * new:>10.2f}{ratio:>8.2f}{flag}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks MCVCM on synthetic fields')
+    parser.add_argument('--sizes', nargs='+', default=['small'], choices=list(sizes),
+                        help='field sizes to benchmark (default small)')
+    parser.add_argument('--repeat', type=int, default=10, help='times each stage is run per size (default 10)')
+    parser.add_argument('--data', default=None,
+                        help='keep the synthetic fields in this folder (and reuse them), instead of a temporary one')
+    parser.add_argument('--compare', default=None, help='a previous benchmark .json to compare the results with')
+    args = parser.parse_args()
+
+    parameter_config = read_config(thisdir, 'parameter_config.json')
+    timings = Timings()
+    root = make_folder(args.data) if args.data else tempfile.mkdtemp(prefix='mcvcm-benchmark-')
+    try:
+        for name in args.sizes:
+            directory = make_folder(os.path.join(root, name))
+            paths = field_files(directory)
+            if not os.path.isfile(paths['infrared_catalog']):
+                print(f'Writing {name} synthetic field to {directory}')
+                with timings(f'{name}: synthetic data'):
+                    make_field(directory, *sizes[name])
+            print(f'Benchmarking {name} field ({args.repeat} repeats)')
+            run_size(name, paths, args.repeat, parameter_config, timings)
+    finally:
+        if not args.data:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print('Profiling imports')
+    imports = import_profile()
+
+    timings.report()
+    print(f'\nmcvcm.py -h: {imports["mcvcm -h"]:.2f}s, session imports: {imports["session imports"]:.2f}s')
+    for name, seconds in imports['slowest imports'].items():
+        print(f'  {name:<30}{seconds:>8.3f}s')
+    bench_path = os.path.join(make_folder(os.path.join(thisdir, 'output', 'benchmarks')),
+                              f'benchmark_{time.strftime("%Y%m%d-%H%M%S")}')
+    json_path, csv_path = timings.write(bench_path)
+
+    # record what the numbers were measured on, next to the stages
+    with open(json_path, 'r') as f:
+        results = json.load(f)
+    results['environment'] = {'python': platform.python_version(), 'numpy': np.__version__,
+                              'machine': platform.machine(), 'processor': platform.processor(),
+                              'cpus': os.cpu_count(), 'sizes': {name: sizes[name] for name in args.sizes},
+                              'repeat': args.repeat}
+    results['imports'] = imports
+    with open(json_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to', json_path, csv_path)
+
+    if args.compare:
+        compare(timings.summary(), args.compare)
+
+
+if __name__ == '__main__':
+    main()
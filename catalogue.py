@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# catalogue.py
+#
+# Catalogue handling for mcvcm.py
+#
+# SkyIndex is built once per catalogue at start-up and answers
+# "which rows are within r of this position" without touching the
+# rest of the catalogue.
+#
+# load_radio() and load_infrared() keep a binary copy of what they read
+# (the parsed table or the needed columns, plus unit vectors) next to
+# the catalogue, so later start-ups skip parsing. The copy is remade
+# whenever the catalogue's path, size or mtime change. Only the columns
+# asked for are read from the infrared catalogue, each into its own
+# contiguous array that is memory-mapped from the cache.
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import json
+import os
+import time
+
+import numpy as np
+
+from utilities import is_fresh, source_stamp
+
+
+def radec_to_xyz(ra, dec):
+    '''
+        Converts RA, Dec (degrees) to unit vectors, shape (n, 3)
+    '''
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cosdec = np.cos(dec)
+    return np.column_stack((cosdec * np.cos(ra), cosdec * np.sin(ra), np.sin(dec)))
+
+
+def xyz_to_radec(xyz):
+    '''
+        Converts vectors, shape (n, 3), to RA, Dec (degrees),
+        they needn't be unit length
+    '''
+    xyz = np.asarray(xyz, dtype=float)
+    ra = np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360
+    dec = np.degrees(np.arctan2(xyz[:, 2], np.hypot(xyz[:, 0], xyz[:, 1])))
+    return ra, dec
+
+
+def chord_length(radius_arcsec):
+    '''
+        Straight-line distance between two unit vectors
+        separated by radius_arcsec on the sky
+    '''
+    return 2 * np.sin(np.radians(radius_arcsec / 3600.) / 2)
+
+
+def chord_arcsec(chord):
+    '''
+        Separation on the sky (arcsec) of two unit
+        vectors chord apart, the inverse of chord_length()
+    '''
+    return np.degrees(2 * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))) * 3600.
+
+
+class SkyIndex(object):
+    '''
+        KD-tree on the unit vectors of a catalogue's positions,
+        used for neighbourhood queries around a target.
+
+        Example usage:
+
+        index = SkyIndex(table['ra'], table['dec'])  # or SkyIndex(None, None, xyz=xyz)
+        rows = index.query(tRA, tDEC, 240)  # catalogue rows within 240 arcsec
+        nearby = table[rows]
+    '''
+
+    def __init__(self, ra, dec, xyz=None):
+        from scipy.spatial import cKDTree
+
+        self.xyz = radec_to_xyz(ra, dec) if xyz is None else xyz
+        self.tree = cKDTree(self.xyz)
+
+    def __len__(self):
+        return len(self.xyz)
+
+    def query(self, ra, dec, radius_arcsec):
+        '''
+            Returns the (sorted) rows within radius_arcsec of ra, dec
+        '''
+        rows = self.tree.query_ball_point(radec_to_xyz(ra, dec)[0], chord_length(radius_arcsec))
+        return np.sort(np.asarray(rows, dtype=int))
+
+
+def friends_of_friends(index, linking_arcsec):
+    '''
+        Friends-of-friends groups of a catalogue, given its SkyIndex:
+        sources closer than linking_arcsec (directly or through a chain
+        of other sources) share a group.
+
+        Returns the group of each row, numbered by its first row
+    '''
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    n = len(index)
+    pairs = index.tree.query_pairs(chord_length(linking_arcsec), output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    first = np.full(labels.max() + 1, n)
+    np.minimum.at(first, labels, np.arange(n))
+    return first[labels]
+
+
+def curve_keys(ra, dec, curve='hilbert', bits=16):
+    '''
+        Position of each source along a space-filling curve (hilbert or
+        morton) over the field, so that sorting by key visits neighbours
+        on the sky one after another
+    '''
+    ra, dec = np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)
+    # flat projection about the field centre, safe across RA = 0
+    ra0 = np.degrees(np.arctan2(np.sin(np.radians(ra)).mean(), np.cos(np.radians(ra)).mean()))
+    x = ((ra - ra0 + 180) % 360 - 180) * np.cos(np.radians(np.median(dec)))
+    y = dec
+    side = max(np.ptp(x), np.ptp(y), 1e-9)
+    n = 2 ** bits
+    x = np.minimum(((x - x.min()) / side * n).astype(np.int64), n - 1)
+    y = np.minimum(((y - y.min()) / side * n).astype(np.int64), n - 1)
+
+    keys = np.zeros(len(x), dtype=np.int64)
+    if curve == 'morton':
+        for bit in range(bits):
+            keys |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+        return keys
+    if curve != 'hilbert':
+        raise ValueError(f'unknown curve {curve}, use hilbert or morton')
+
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return keys
+
+
+def unambiguous_matches(radio, infrared, radius_arcsec, isolation_arcsec):
+    '''
+        Radio sources with no other radio source within isolation_arcsec
+        and exactly one infrared source within radius_arcsec, given
+        the SkyIndex of each catalogue.
+
+        Returns (radio rows, matching infrared rows)
+    '''
+    # counts include the source itself
+    radio_neighbours = radio.tree.query_ball_point(radio.xyz, chord_length(isolation_arcsec), return_length=True)
+    candidates = infrared.tree.query_ball_point(radio.xyz, chord_length(radius_arcsec), return_length=True)
+    rows = np.flatnonzero((radio_neighbours == 1) & (candidates == 1))
+    _, hosts = infrared.tree.query(radio.xyz[rows], k=1)
+    return rows, np.asarray(hosts, dtype=int)
+
+
+def cache_paths(catalogue_path):
+    '''
+        Paths of the binary cache of a catalogue and its json index
+    '''
+    return catalogue_path + '.cache.npz', catalogue_path + '.cache.json'
+
+
+def _report(progress, start, rows, source):
+    if progress:
+        print(f'  {rows} rows {source} in {time.perf_counter() - start:.1f}s', flush=True)
+
+
+def _read_cache(catalogue_path, columns):
+    cache_path, index_path = cache_paths(catalogue_path)
+    if not is_fresh(index_path, catalogue_path, columns=columns):
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as cache:
+            return {key: cache[key] for key in cache.files}
+    except (OSError, ValueError) as e:
+        print(f'WARNING: could not read catalogue cache {cache_path} ({e}), rereading the catalogue')
+        return None
+
+
+def _write_cache(catalogue_path, columns, **arrays):
+    '''
+        Saves arrays next to the catalogue, warns (and carries on)
+        if that isn't possible, e.g. a read-only data folder
+    '''
+    cache_path, index_path = cache_paths(catalogue_path)
+    temp_path = cache_path[:-len('.npz')] + '.tmp.npz'
+    try:
+        np.savez(temp_path, **arrays)
+        os.replace(temp_path, cache_path)
+        index = {'cache': os.path.basename(cache_path), 'columns': columns}
+        index.update(source_stamp(catalogue_path))
+        with open(index_path, 'w') as f:
+            json.dump(index, f, indent=2)
+    except (OSError, ValueError) as e:
+        print(f'WARNING: could not cache catalogue {catalogue_path} ({e})')
+
+
+def load_radio(path, ra_column, dec_column, cache=True, progress=False):
+    '''
+        Reads the radio catalogue (an ascii table) into an astropy Table,
+        returns (table, unit vectors of its positions)
+    '''
+    from astropy.table import Table
+
+    start = time.perf_counter()
+    arrays = _read_cache(path, [ra_column, dec_column]) if cache else None
+    if arrays is None:
+        from astropy.io import ascii
+
+        if progress:
+            print('  parsing (cached for next time) ...', flush=True)
+        table = ascii.read(path)
+        xyz = radec_to_xyz(table[ra_column], table[dec_column])
+        if cache:
+            data = table.as_array()
+            arrays = {'data': np.ma.getdata(data), 'xyz': xyz}
+            if table.has_masked_values:
+                arrays['mask'] = np.ma.getmaskarray(data)
+            _write_cache(path, [ra_column, dec_column], **arrays)
+        _report(progress, start, len(table), 'parsed')
+        return table, xyz
+
+    data = arrays['data']
+    if 'mask' in arrays:
+        data = np.ma.array(data, mask=arrays['mask'])
+    _report(progress, start, len(data), 'from cache')
+    return Table(data), arrays['xyz']
+
+
+class ColumnTable(object):
+    '''
+        A few catalogue columns, each a contiguous (possibly memory-mapped)
+        array. Indexed like a table: by name for a column, by rows
+        (index, slice, mask or row numbers) for a ColumnTable of those rows.
+
+        Example usage:
+
+        table = ColumnTable({'ra': ra, 'dec': dec})
+        nearby = table[rows]
+        nearby['ra']
+    '''
+
+    def __init__(self, columns):
+        self.columns = dict(columns)
+
+    @property
+    def colnames(self):
+        return list(self.columns)
+
+    def __len__(self):
+        return len(next(iter(self.columns.values())))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[key]
+        return ColumnTable({name: column[key] for name, column in self.columns.items()})
+
+
+def column_paths(catalogue_path):
+    '''
+        Folder of the per-column cache of a catalogue and its json index
+    '''
+    return catalogue_path + '.columns', catalogue_path + '.columns.json'
+
+
+def _write_columns(catalogue_path, columns, xyz):
+    '''
+        Saves each column (and the unit vectors) as its own .npy file,
+        so they can be memory-mapped independently
+    '''
+    folder, index_path = column_paths(catalogue_path)
+    try:
+        os.makedirs(folder, exist_ok=True)
+        for name in os.listdir(folder):  # columns of a previous configuration
+            os.remove(os.path.join(folder, name))
+        files = {}
+        for i, (name, column) in enumerate(list(columns.items()) + [('xyz', xyz)]):
+            files[name] = f'{i}.npy' if name != 'xyz' else 'xyz.npy'
+            temp_path = os.path.join(folder, files[name] + '.tmp.npy')
+            np.save(temp_path, column)
+            os.replace(temp_path, os.path.join(folder, files[name]))
+        index = {'folder': os.path.basename(folder), 'columns': list(columns), 'files': files}
+        index.update(source_stamp(catalogue_path))
+        with open(index_path, 'w') as f:
+            json.dump(index, f, indent=2)
+    except (OSError, ValueError) as e:
+        print(f'WARNING: could not cache catalogue {catalogue_path} ({e})')
+
+
+def load_infrared(path, columns, ra_column, dec_column, cache=True, progress=False):
+    '''
+        Reads only columns from the infrared catalogue (first FITS extension,
+        memory-mapped so the other columns are never read), returns
+        (ColumnTable, unit vectors of its positions)
+
+        Each column is cached as a contiguous .npy file, memory-mapped
+        on later start-ups
+    '''
+    start = time.perf_counter()
+    columns = list(dict.fromkeys(columns))  # in order, without repeats
+    folder, index_path = column_paths(path)
+    if cache and is_fresh(index_path, path, columns=columns):
+        with open(index_path, 'r') as f:
+            files = json.load(f)['files']
+        try:
+            table = ColumnTable({name: np.load(os.path.join(folder, files[name]), mmap_mode='r')
+                                 for name in columns})
+            xyz = np.load(os.path.join(folder, files['xyz']), mmap_mode='r')
+            _report(progress, start, len(table), 'from cache')
+            return table, xyz
+        except (OSError, ValueError) as e:
+            print(f'WARNING: could not read catalogue cache {folder} ({e}), rereading the catalogue')
+
+    from astropy.io import fits
+
+    if progress:
+        print(f'  reading {len(columns)} columns (cached for next time) ...', flush=True)
+    with fits.open(path, memmap=True) as hdul:
+        data = hdul[1].data
+        # native byte order, and str rather than bytes for text columns (as FITS_rec gives them)
+        table = ColumnTable({name: np.ascontiguousarray(data[name], dtype=data.dtype[name].newbyteorder('=')
+                                                        if data.dtype[name].kind != 'S'
+                                                        else f'U{data.dtype[name].itemsize}')
+                             for name in columns})
+        del data
+    xyz = radec_to_xyz(table[ra_column], table[dec_column])
+    if cache:
+        _write_columns(path, table.columns, xyz)
+    _report(progress, start, len(table), 'read')
+    return table, xyz
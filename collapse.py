@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# collapse.py
+#
+# Collapses the cross-matched radio components of a field into a source
+# catalogue, one row per source (components sharing radio core and
+# infrared host), with:
+#
+#   summed radio flux, flux-weighted centroid, number of components,
+#   largest angular size (LAS, the widest component separation),
+#   certainty, and the position and chosen columns of the infrared host
+#
+# Tags are read from the session journal/database or a saved mcvcm table,
+# and everything is done with array group-bys, so whole survey catalogues
+# take seconds, e.g.:
+#
+#   >> collapse.py ELAIS --output output/tables/ELAIS_sources.fits
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from utilities import field_paths, make_folder, read_config
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+
+def collapse(xmatch, rTable, rXYZ, iTable, iXYZ, columns, flux_column, host_columns=()):
+    '''
+        One row per cross-matched source of xmatch, as an astropy Table
+
+        Components are sorted source by source once, then every property
+        is a bincount or reduceat over those runs. Sources without an
+        infrared host have their host columns masked.
+    '''
+    import catalogue
+    from astropy.table import MaskedColumn, Table
+    from identity import unresolved_row
+
+    lost = np.count_nonzero(xmatch.core == unresolved_row)
+    if lost:
+        print(f'WARNING: {lost} tags name sources missing from the catalogues and are left out')
+
+    # components of one source (same radio core and infrared host) next to each other
+    tagged = np.flatnonzero(xmatch.core >= 0)
+    key = xmatch.core[tagged].astype(np.int64) * (len(iTable) + 1) + xmatch.host[tagged] + 1
+    order = np.argsort(key, kind='stable')
+    rows, key = tagged[order], key[order]
+    first = np.flatnonzero(np.r_[True, key[1:] != key[:-1]]) if len(rows) else np.array([], dtype=int)
+    counts = np.diff(np.r_[first, len(rows)])
+    source = np.repeat(np.arange(len(first)), counts)
+    core, host = xmatch.core[rows[first]], xmatch.host[rows[first]]
+
+    incomplete = np.count_nonzero(counts != xmatch.ncomp[rows[first]])
+    if incomplete:
+        print(f'WARNING: {incomplete} sources have a different number of components than their tags record')
+
+    # summed flux (missing fluxes count as zero), and a centroid weighted by
+    # the positive fluxes (by position alone if a source has none)
+    flux = np.ma.filled(np.ma.asarray(rTable[flux_column]).astype(float), np.nan)[rows]
+    total = np.bincount(source, weights=np.nan_to_num(flux), minlength=len(first))
+    weight = np.where(np.isfinite(flux) & (flux > 0), flux, 0.)
+    weight[np.bincount(source, weights=weight, minlength=len(first))[source] == 0] = 1.
+    centre = np.column_stack([np.bincount(source, weights=weight * rXYZ[rows, axis], minlength=len(first))
+                              for axis in range(3)])
+    ra, dec = catalogue.xyz_to_radec(centre)
+
+    # LAS, over every pair of components within each source (pairs are in source order)
+    size = counts[source]
+    i = np.repeat(np.arange(len(rows)), size)
+    j = np.repeat(first[source], size) + np.arange(len(i)) - np.repeat(np.cumsum(size) - size, size)
+    chord = np.linalg.norm(rXYZ[rows[i]] - rXYZ[rows[j]], axis=1)
+    las = np.maximum.reduceat(chord, np.r_[0, np.cumsum(counts ** 2)[:-1]]) if len(rows) else chord
+
+    no_host = host < 0
+    host_row = np.maximum(host, 0)
+    unit = centre / np.linalg.norm(centre, axis=1)[:, None] if len(rows) else centre
+
+    sources = Table()
+    sources['radio_host'] = np.asarray(rTable[columns['radio_id']])[core].astype(str)
+    sources['infrared_host'] = np.where(no_host, xmatch.default_inf_host[0],
+                                        np.asarray(iTable[columns['infrared_id']])[host_row].astype(str))
+    sources[columns['radio_ra']], sources[columns['radio_dec']] = ra, dec
+    sources[flux_column] = total
+    sources['n_components'] = counts
+    sources['las_arcsec'] = catalogue.chord_arcsec(las)
+    sources['mcvcm_flag'] = xmatch.flag[core].astype(int)
+
+    for name in [columns['infrared_ra'], columns['infrared_dec']] + list(host_columns):
+        label = name if name not in sources.colnames else f'host_{name}'
+        sources[label] = MaskedColumn(np.asarray(iTable[name])[host_row], mask=no_host)
+    sources['host_separation_arcsec'] = MaskedColumn(
+        catalogue.chord_arcsec(np.linalg.norm(iXYZ[host_row] - unit, axis=1)), mask=no_host)
+    return sources
+
+
+def main():
+    path_config = read_config(thisdir, 'path_config.json')
+    field_choices = tuple(path_config.keys())
+    parameter_config = read_config(thisdir, 'parameter_config.json')
+    defaults = parameter_config['collapse']
+
+    parser = argparse.ArgumentParser(description='Collapses the cross-matched components of a field into a '
+                                                 'source catalogue')
+    parser.add_argument('field', choices=field_choices, help=f'specify the field to collapse: {field_choices}')
+    parser.add_argument('--table', default=None, help='read tags from this saved mcvcm table instead')
+    parser.add_argument('--output', default=None,
+                        help='file to write, format from its extension (default output/tables/<field>_mcvcm_sources.dat)')
+    parser.add_argument('--flux', default=defaults['radio_flux'],
+                        help=f'radio flux column to sum (default {defaults["radio_flux"]})')
+    parser.add_argument('-d', help='collapse the demo session', action='store_true', default=False)
+    args = parser.parse_args()
+
+    import catalogue
+    import session
+    from identity import CrossMatch
+
+    columns = parameter_config['column_names']
+    host_columns = defaults['infrared_columns']
+    paths = field_paths(thisdir, args.field)
+    output = 'demo_output' if args.d else 'output'
+    prefix = 'demo-' if args.d else ''
+    table_path = make_folder(os.path.join(thisdir, output, 'tables'))
+    save_path = os.path.join(table_path, f'{prefix}{args.field}_mcvcm_table.dat')
+    out_path = args.output or os.path.join(table_path, f'{prefix}{args.field}_mcvcm_sources.dat')
+
+    print(f'Reading radio table: {paths["radio_catalog"]}')
+    rTable, rXYZ = catalogue.load_radio(paths['radio_catalog'], columns['radio_ra'], columns['radio_dec'],
+                                        progress=True)
+    if args.flux not in rTable.colnames:
+        raise Exception(f'No flux column {args.flux} in {paths["radio_catalog"]}, set collapse: radio_flux '
+                        f'in parameter_config.json or pass --flux')
+    print(f'Reading infrared table: {paths["infrared_catalog"]}')
+    iTable, iXYZ = catalogue.load_infrared(paths['infrared_catalog'],
+                                           [columns['infrared_id'], columns['infrared_ra'], columns['infrared_dec']]
+                                           + host_columns, columns['infrared_ra'], columns['infrared_dec'],
+                                           progress=True)
+
+    xmatch = CrossMatch(rTable[columns['radio_id']], iTable[columns['infrared_id']])
+    session.load_tags(xmatch, columns['radio_id'], save_path, parameter_config['session']['backend'],
+                      table=args.table)
+
+    start = time.perf_counter()
+    sources = collapse(xmatch, rTable, rXYZ, iTable, iXYZ, columns, args.flux, host_columns)
+    print(f'Collapsed {np.count_nonzero(xmatch.core >= 0)} components into {len(sources)} sources '
+          f'in {time.perf_counter() - start:.2f}s')
+
+    if out_path.endswith('.dat'):
+        session.write_table(sources, out_path)
+    else:
+        sources.write(out_path, overwrite=True)
+    print(f'Source catalogue written to {out_path}')
+
+
+if __name__ == '__main__':
+    main()
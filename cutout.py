@@ -25,16 +25,20 @@
 from __future__ import division
 from __future__ import print_function
 
+import os
+import threading
 import time
 import warnings
+from collections import OrderedDict
 
 import astropy.wcs as wcs
 import matplotlib.pyplot as plt
 import numpy as np
-import reproject
 from astropy.io import fits
 from astropy.utils.exceptions import AstropyWarning
 
+from utilities import Timings, is_fresh, source_stamp
+
 warnings.filterwarnings('ignore', category=AstropyWarning, append=True)
 warnings.filterwarnings('ignore', category=RuntimeWarning)
 # matplotlib.rcParams.update({'figure.autolayout': True})
@@ -67,14 +71,14 @@ class Timer(object):
             with Timer() as t:
                 <RUN CODE>
                 ts.append(t.interval)
-        print 'mean was', np.mean(ts)
+        print('mean was', np.mean(ts))
     '''
     def __enter__(self):
-        self.start = time.clock()
+        self.start = time.perf_counter()
         return self
 
     def __exit__(self, *args):
-        self.end = time.clock()
+        self.end = time.perf_counter()
         self.interval = self.end - self.start
 
 
@@ -82,10 +86,8 @@ def rms(arr):
     '''
         find the RMS of input array
     '''
-    from math import sqrt
-    if len(arr.shape) > 1:
-        arr = arr.flatten()
-    return sqrt(old_div(np.nansum([x*x for x in arr]),len(arr)))
+    arr = np.asarray(arr, dtype=float)
+    return np.sqrt(np.nansum(arr * arr) / arr.size)
 
 
 def arr_slice(arr, slicer, size):
@@ -108,86 +110,696 @@ def arr_slice(arr, slicer, size):
     return sliced
 
 
-def cutouts2(infrared_mosaic, radio_image, radio_rms, targetRA, targetDEC, isize=200, rsize=180, vmax=1.5,
-             verbose=False):
-    """
+class FitsImage(object):
+    '''
+        Windowed reads from the last two axes of a FITS image HDU.
 
-    :param infrared_mosaic: asklujdhlkjhasdh
-    :param radio_image: asdljhaskljhda
-    :param radio_rms: asdioahsopd;a
-    :param targetRA:
-    :param targetDEC:
-    :param isize:
-    :param rsize:
-    :param vmax:
-    :param verbose:
-    :return:
-    """
-    from matplotlib.colors import PowerNorm  # ,LogNorm, SymLogNorm,
-    from astropy.nddata.utils import Cutout2D
+        Reads go through hdu.section, so only the rows of the window
+        are read from disk (scaled data, i.e. BSCALE/BZERO, included)
+        and resident memory stays flat whatever the mosaic size.
+        Degenerate leading axes, e.g. the (1,1,n,m) radio maps, are
+        indexed at 0.
+    '''
 
-    if fits.getdata(radio_image)[0][0].shape != fits.getdata(radio_rms)[0][0].shape:
-        raise Exception('Check that the radio image and radio rms files match')
+    def __init__(self, hdu):
+        self.hdu = hdu
+        self.shape = tuple(hdu.shape[-2:])  # from the header, does not read the data
+        self.leading = (0,) * (len(hdu.shape) - 2)
+        self.wcs = wcs.WCS(hdu.header).celestial
+
+    def read(self, yslice, xslice):
+        return self.hdu.section[self.leading + (yslice, xslice)]
+
+    def cutout(self, position, size, fill_value=0., with_wcs=True):
+        '''
+            Square cutout of size pixels centred on position (x, y),
+            the same window as Cutout2D(mode='partial'). Any part
+            outside the image is padded with fill_value.
+
+            Returns the data and (if with_wcs) the cutout WCS
+        '''
+        ny, nx = self.shape
+        x0 = int(np.ceil(position[0] - size / 2.))
+        y0 = int(np.ceil(position[1] - size / 2.))
+
+        data = np.full((size, size), fill_value, dtype=float)
+        xa, xb = max(x0, 0), min(x0 + size, nx)
+        ya, yb = max(y0, 0), min(y0 + size, ny)
+        if xa < xb and ya < yb:
+            data[ya - y0:yb - y0, xa - x0:xb - x0] = self.read(slice(ya, yb), slice(xa, xb))
+
+        cutwcs = None
+        if with_wcs:
+            cutwcs = self.wcs.deepcopy()
+            cutwcs.wcs.crpix -= (x0, y0)
+            if cutwcs.sip is not None:
+                cutwcs.sip = wcs.Sip(cutwcs.sip.a, cutwcs.sip.b, cutwcs.sip.ap, cutwcs.sip.bp,
+                                     cutwcs.sip.crpix - (x0, y0))
+        return data, cutwcs
+
+
+class TiledImage(FitsImage):
+    '''
+        Windowed reads from a tiled copy of a mosaic (see preprocess.py --tile).
 
-    target_radec = (targetRA, targetDEC)
+        The image is stored as a .npy array of shape (nty, ntx, tile, tile)
+        with its celestial WCS in a json index alongside. Each tile is
+        contiguous on disk, so a cutout reads only the few tiles that
+        cover it instead of one strided run per image row.
+    '''
 
-    # Work out the integer pixel position of the target coordinates in optical
-    imap_full = wcs.WCS(infrared_mosaic)
-    ipix = imap_full.wcs_world2pix([target_radec], 1)  # wcs conversions take list of lists
-    ipix = [int(x) for x in ipix[0]]  # ensure returned pixels are integer
+    def __init__(self, index_path):
+        import json
+
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        self.shape = tuple(index['shape'])
+        self.tile = index['tile']
+        self.tiles = np.load(os.path.join(os.path.dirname(index_path), index['tiles']), mmap_mode='r')
+        self.wcs = wcs.WCS(fits.Header.fromstring(index['header']))
+
+    def read(self, yslice, xslice):
+        t = self.tile
+        data = np.empty((yslice.stop - yslice.start, xslice.stop - xslice.start), dtype=self.tiles.dtype)
+        for ty in range(yslice.start // t, (yslice.stop - 1) // t + 1):
+            ya, yb = max(yslice.start, ty * t), min(yslice.stop, (ty + 1) * t)
+            for tx in range(xslice.start // t, (xslice.stop - 1) // t + 1):
+                xa, xb = max(xslice.start, tx * t), min(xslice.stop, (tx + 1) * t)
+                data[ya - yslice.start:yb - yslice.start, xa - xslice.start:xb - xslice.start] = \
+                    self.tiles[ty, tx, ya - ty * t:yb - ty * t, xa - tx * t:xb - tx * t]
+        return data
+
+
+def tile_paths(image_path):
+    '''
+        Paths of the tile array and json index for a mosaic
+    '''
+    base = os.path.splitext(image_path)[0]
+    return base + '.tiles.npy', base + '.tiles.json'
 
-    verboseprint('o_full shape', fits.getdata(infrared_mosaic).shape)
-    verboseprint('optical pix center', ipix)
 
-    # Work out the integer pixel position of the target coordinates in radio
-    rmap_full = wcs.WCS(radio_image).celestial
-    rpix = rmap_full.wcs_world2pix([target_radec], 1)
-    rpix = [int(x) for x in rpix[0]]
+def write_tiles(image_path, tile=256, verbose=False):
+    '''
+        Rewrites the image (last two axes) of a FITS mosaic as
+        contiguous tile x tile blocks, read back by TiledImage
+    '''
+    import json
+
+    tiles_path, index_path = tile_paths(image_path)
+    with fits.open(image_path, memmap=True) as hdul:
+        image = FitsImage(hdul[0])
+        ny, nx = image.shape
+        nty, ntx = -(-ny // tile), -(-nx // tile)
+        dtype = np.float32 if hdul[0].header['BITPIX'] == -32 else np.float64
+
+        tiles = np.lib.format.open_memmap(tiles_path + '.tmp', mode='w+', dtype=dtype, shape=(nty, ntx, tile, tile))
+        for ty in range(nty):
+            # one band of tile rows at a time, padded to whole tiles with nan
+            band = np.full((tile, ntx * tile), np.nan, dtype=dtype)
+            rows = image.read(slice(ty * tile, min((ty + 1) * tile, ny)), slice(0, nx))
+            band[:rows.shape[0], :nx] = rows
+            tiles[ty] = band.reshape(tile, ntx, tile).swapaxes(0, 1)
+            if verbose:
+                print(f'\r{image_path}: tile row {ty + 1}/{nty}', end='', flush=True)
+        tiles.flush()
+        del tiles
+        header = image.wcs.to_header_string(relax=True)
+
+    os.replace(tiles_path + '.tmp', tiles_path)
+    index = {'shape': [ny, nx], 'tile': tile, 'tiles': os.path.basename(tiles_path), 'header': header}
+    index.update(source_stamp(image_path))
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    if verbose:
+        print()
+    return index_path
 
-    verboseprint('r_full shape', fits.getdata(radio_image).shape)
-    verboseprint('radio pix center', rpix)
 
-    icut = Cutout2D(fits.getdata(infrared_mosaic), ipix, (isize, isize), mode='partial', fill_value=0.,
-                    wcs=wcs.WCS(infrared_mosaic).celestial)
-    imap = icut.wcs
+class ArrayImage(FitsImage):
+    '''
+        Windowed reads from a 2D .npy array on the pixel grid of wcs
+    '''
 
-    rcut = Cutout2D(fits.getdata(radio_image)[0][0], rpix, (rsize, rsize), mode='partial', fill_value=0.,
-                    wcs=wcs.WCS(radio_image).celestial)
-    rmap = rcut.wcs
+    def __init__(self, array_path, wcs):
+        self.array = np.load(array_path, mmap_mode='r')
+        self.shape = self.array.shape
+        self.wcs = wcs
 
-    # Contours are to be in steps of (2^n)*(2.5*median(local_rms))
-    contours = [2 ** x for x in range(17)]
-    rms_cut = Cutout2D(fits.getdata(radio_rms)[0][0], rpix, (rsize, rsize), mode='partial', fill_value=np.nan)
-    rmap = rcut.wcs
-    local_rms = 2.5 * np.nanmedian(rms_cut.data.flatten())
-    contours = [local_rms * x for x in contours]
+    def read(self, yslice, xslice):
+        return self.array[yslice, xslice]
 
-    # project radio coordinates (rcut,rmap) onto optical projection omap
-    # Fails unless you specifying the shape_out (to be the same as what you are projecting onto)
-    # Since omap doesn't have a .shape, ocut.shape is used instead
 
-    project_r, footprint = reproject.reproject_interp((rcut.data, rmap), imap, shape_out=icut.data.shape)
+def projected_paths(radio_image, infrared_mosaic):
+    '''
+        Paths of the radio map reprojected onto the infrared grid, and its json index
+    '''
+    base = f'{os.path.splitext(radio_image)[0]}.on_{os.path.splitext(os.path.basename(infrared_mosaic))[0]}'
+    return base + '.npy', base + '.json'
 
-    figure = plt.figure()  # figsize=(6.55, 5.2))
-    axis = figure.add_subplot(111, projection=imap)
-    # fig.subplots_adjust(left=0.25, right=.60)
 
-    axtrans = axis.get_transform(
-        'fk5')  # necessary for scattering data on later -- e.g ax.plot(data, transform=axtrans)
+def _reproject_strip(radio_image, infrared_mosaic, array_path, y0, y1):
+    '''
+        Reprojects rows y0:y1 of the infrared grid, reading only
+        the window of the radio map that covers them
+    '''
+    with fits.open(radio_image, memmap=True) as rhdul, fits.open(infrared_mosaic, memmap=True) as ihdul:
+        radio = FitsImage(rhdul[0])
+        iwcs = wcs.WCS(ihdul[0].header).celestial
+        nx = ihdul[0].shape[-1]
+
+        strip_wcs = iwcs.deepcopy()
+        strip_wcs.wcs.crpix -= (0, y0)
+
+        # radio pixels under the strip's outline, plus a margin for the interpolation
+        xs = np.r_[np.linspace(0, nx - 1, 64), np.zeros(16), np.full(16, nx - 1), np.linspace(0, nx - 1, 64)]
+        ys = np.r_[np.full(64, y0), np.linspace(y0, y1 - 1, 16), np.linspace(y0, y1 - 1, 16), np.full(64, y1 - 1)]
+        world = iwcs.wcs_pix2world(np.column_stack((xs, ys)), 0)
+        rx, ry = radio.wcs.wcs_world2pix(world, 0).T
+        ok = np.isfinite(rx) & np.isfinite(ry)
+
+        out = np.load(array_path, mmap_mode='r+')
+        out[y0:y1] = np.nan
+        if ok.any():
+            ny_r, nx_r = radio.shape
+            xa, xb = max(int(np.floor(rx[ok].min())) - 2, 0), min(int(np.ceil(rx[ok].max())) + 3, nx_r)
+            ya, yb = max(int(np.floor(ry[ok].min())) - 2, 0), min(int(np.ceil(ry[ok].max())) + 3, ny_r)
+            if xa < xb and ya < yb:
+                window_wcs = radio.wcs.deepcopy()
+                window_wcs.wcs.crpix -= (xa, ya)
+                from reproject import reproject_interp
+                projected, footprint = reproject_interp(
+                    (radio.read(slice(ya, yb), slice(xa, xb)), window_wcs), strip_wcs, shape_out=(y1 - y0, nx))
+                out[y0:y1] = projected
+        out.flush()
+    return y1
+
+
+def write_projected(radio_image, infrared_mosaic, strip=512, workers=None, verbose=False):
+    '''
+        Reprojects the whole radio map onto the infrared mosaic's pixel
+        grid, in strips of rows spread over a process pool. The result
+        is a float32 .npy array the shape of the infrared mosaic.
+    '''
+    import json
+    from concurrent.futures import ProcessPoolExecutor
+
+    array_path, index_path = projected_paths(radio_image, infrared_mosaic)
+    with fits.open(infrared_mosaic, memmap=True) as ihdul:
+        ny, nx = ihdul[0].shape[-2:]
+
+    temp_path = array_path[:-len('.npy')] + '.tmp.npy'
+    np.lib.format.open_memmap(temp_path, mode='w+', dtype=np.float32, shape=(ny, nx)).flush()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_reproject_strip, radio_image, infrared_mosaic, temp_path, y0, min(y0 + strip, ny))
+                   for y0 in range(0, ny, strip)]
+        for done, future in enumerate(futures, 1):
+            future.result()
+            if verbose:
+                print(f'\r{radio_image}: strip {done}/{len(futures)}', end='', flush=True)
+
+    os.replace(temp_path, array_path)
+    index = {'shape': [ny, nx], 'array': os.path.basename(array_path)}
+    index.update(source_stamp(radio_image, infrared_mosaic))
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    if verbose:
+        print()
+    return index_path
 
-    #### CHANGE VMAX HERE TO SUIT YOUR DATA - (I just experimented) #####
-    # plotting
-    normalise = PowerNorm(gamma=.7)
-    axis.imshow(icut.data, origin='lower', cmap='gist_heat_r', norm=normalise,
-                vmax=vmax)  # origin='lower' for .fits files
-    axis.contour(np.arange(project_r.shape[0]), np.arange(project_r.shape[1]), project_r, levels=contours,
-                 linewidths=0.8)
 
-    axis.set_autoscale_on(False)
-    axis.coords['RA'].set_axislabel('Right Ascension')
-    axis.coords['DEC'].set_axislabel('Declination')
+class RmsGrid(object):
+    '''
+        Coarse grid of local median RMS over a radio RMS map (see
+        preprocess.py --rms-grid). Node (j, i) holds the nanmedian of
+        the window x window pixels centred on pixel (j*step, i*step),
+        so the contour base level for any position is a single lookup.
+    '''
+
+    def __init__(self, index_path):
+        import json
+
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        self.step = index['step']
+        self.window = index['window']
+        self.grid = np.load(os.path.join(os.path.dirname(index_path), index['grid']))
+
+    def lookup(self, xpix, ypix):
+        '''
+            Local median RMS at 0-based radio pixel positions (scalars or arrays)
+        '''
+        ny, nx = self.grid.shape
+        i = np.clip(np.rint(np.asarray(xpix, dtype=float) / self.step).astype(int), 0, nx - 1)
+        j = np.clip(np.rint(np.asarray(ypix, dtype=float) / self.step).astype(int), 0, ny - 1)
+        return self.grid[j, i]
+
 
-    return figure, axis, axtrans, imap
+def rms_grid_paths(rms_image):
+    '''
+        Paths of the local median RMS grid and its json index
+    '''
+    base = os.path.splitext(rms_image)[0]
+    return base + '.rmsgrid.npy', base + '.rmsgrid.json'
+
+
+def write_rms_grid(rms_image, window, step=32, verbose=False):
+    '''
+        Computes the local median RMS on a grid of nodes every step pixels,
+        each over the same window cutouts2() takes its median from
+    '''
+    import json
+
+    grid_path, index_path = rms_grid_paths(rms_image)
+    half = window // 2
+    with fits.open(rms_image, memmap=True) as hdul:
+        image = FitsImage(hdul[0])
+        ny, nx = image.shape
+        ys, xs = np.arange(0, ny, step), np.arange(0, nx, step)
+        grid = np.empty((len(ys), len(xs)), dtype=np.float32)
+
+        for row, y in enumerate(ys):
+            # NaN-padded band of rows, so every window is window x window
+            band = np.full((window, nx + window), np.nan)
+            ya, yb = max(y - half, 0), min(y - half + window, ny)
+            band[ya - (y - half):yb - (y - half), half:half + nx] = image.read(slice(ya, yb), slice(0, nx))
+            windows = np.lib.stride_tricks.sliding_window_view(band, (window, window))[0]
+            for start in range(0, len(xs), 64):
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)  # windows off the map are all NaN
+                    grid[row, start:start + 64] = np.nanmedian(windows[xs[start:start + 64]], axis=(1, 2))
+            if verbose:
+                print(f'\r{rms_image}: grid row {row + 1}/{len(ys)}', end='', flush=True)
+
+    np.save(grid_path, grid)
+    index = {'step': step, 'window': window, 'grid': os.path.basename(grid_path)}
+    index.update(source_stamp(rms_image))
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    if verbose:
+        print()
+    return index_path
+
+
+def open_image(hdu, image_path):
+    '''
+        A TiledImage if an up to date tiled copy of image_path exists,
+        otherwise a FitsImage reading from hdu
+    '''
+    index_path = tile_paths(image_path)[1]
+    if is_fresh(index_path, image_path):
+        verboseprint('using tiles', index_path)
+        return TiledImage(index_path)
+    return FitsImage(hdu)
+
+
+class Cutout(object):
+    '''
+        The arrays needed to draw one target: the infrared cutout
+        and its WCS, the radio cutout reprojected onto that WCS,
+        and the radio contour levels
+    '''
+    def __init__(self, image, imap, radio, levels):
+        self.image = image
+        self.imap = imap
+        self.radio = radio
+        self.levels = levels
+
+
+class CutoutEngine(object):
+    '''
+        Serves cutouts from mosaics that are opened once per session.
+
+        The infrared mosaic, radio continuum and radio rms maps are
+        memory-mapped and their celestial WCS parsed on creation, so
+        the cost of a cutout no longer depends on the mosaic size.
+        The local rms grid is used only if it was made with rms_window,
+        the radio cutout size contour levels are taken over.
+
+        Example usage:
+
+        engine = CutoutEngine(swire, radio, noise, rms_window=95)
+        fig, ax, axtrans, imap = engine.cutouts2(ra, dec, isize=170, rsize=95)
+    '''
+
+    def __init__(self, infrared_mosaic, radio_image, radio_rms, vmax=1.5, gamma=0.7, rms_window=None, verbose=False,
+                 timings=None):
+        self.vmax = vmax
+        self.gamma = gamma
+        self.verbose = verbose
+        self.timings = timings if timings is not None else Timings(enabled=False)
+
+        self.ihdul = fits.open(infrared_mosaic, memmap=True)
+        self.rhdul = fits.open(radio_image, memmap=True)
+        self.nhdul = fits.open(radio_rms, memmap=True)
+
+        # windowed access only, the full data arrays are never read
+        # tiled copies (see preprocess.py) are used when up to date
+        self.infrared = open_image(self.ihdul[0], infrared_mosaic)
+        self.radio = open_image(self.rhdul[0], radio_image)
+        self.rms = open_image(self.nhdul[0], radio_rms)
+
+        if self.radio.shape != self.rms.shape:
+            raise Exception('Check that the radio image and radio rms files match')
+
+        self.iwcs = self.infrared.wcs
+        self.rwcs = self.radio.wcs
+
+        # radio map already reprojected onto the infrared grid (see preprocess.py), if up to date
+        self.projected = None
+        array_path, index_path = projected_paths(radio_image, infrared_mosaic)
+        if is_fresh(index_path, radio_image, infrared_mosaic):
+            verboseprint('using reprojected radio', array_path)
+            self.projected = ArrayImage(array_path, self.iwcs)
+
+        # local median RMS grid (see preprocess.py), if up to date and over the same window
+        self.rms_grid = None
+        index_path = rms_grid_paths(radio_rms)[1]
+        if rms_window is not None and is_fresh(index_path, radio_rms, window=rms_window):
+            verboseprint('using local rms grid', index_path)
+            self.rms_grid = RmsGrid(index_path)
+
+        # the full-mosaic WCS and file handles are shared with prefetch threads
+        self._lock = threading.Lock()
+
+        verboseprint('o_full shape', self.infrared.shape)
+        verboseprint('r_full shape', self.radio.shape)
+
+    def close(self):
+        for hdul in (self.ihdul, self.rhdul, self.nhdul):
+            hdul.close()
+
+    def prepare(self, targetRA, targetDEC, isize=200, rsize=180):
+        '''
+            Cuts out and reprojects the data about a target,
+            returns a Cutout ready for plotting
+        '''
+        target_radec = (targetRA, targetDEC)
+
+        timings = self.timings
+        with self._lock:
+            with timings('cutout coordinates'):
+                # Work out the integer pixel position of the target coordinates in optical
+                ipix = self.iwcs.wcs_world2pix([target_radec], 1)  # wcs conversions take list of lists
+                ipix = [int(x) for x in ipix[0]]  # ensure returned pixels are integer
+                verboseprint('optical pix center', ipix)
+
+                # Work out the integer pixel position of the target coordinates in radio
+                rpix = self.rwcs.wcs_world2pix([target_radec], 1)
+                rpix = [int(x) for x in rpix[0]]
+                verboseprint('radio pix center', rpix)
+
+            # windowed read of each mosaic, including the cutout WCS
+            with timings('mosaic read'):
+                icut, imap = self.infrared.cutout(ipix, isize, fill_value=0.)
+                if self.projected is not None:
+                    project_r, _ = self.projected.cutout(ipix, isize, fill_value=np.nan, with_wcs=False)
+                else:
+                    rcut, rmap = self.radio.cutout(rpix, rsize, fill_value=0.)
+                if self.rms_grid is None:
+                    rms_cut, _ = self.rms.cutout(rpix, rsize, fill_value=np.nan, with_wcs=False)
+
+        # Contours are to be in steps of (2^n)*(2.5*median(local_rms))
+        with timings('contour levels'):
+            contours = [2 ** x for x in range(17)]
+            if self.rms_grid is not None:
+                local_rms = 2.5 * float(self.rms_grid.lookup(rpix[0] - 1, rpix[1] - 1))
+            else:
+                local_rms = 2.5 * np.nanmedian(rms_cut.flatten())
+            contours = [local_rms * x for x in contours]
+
+        # project radio coordinates (rcut,rmap) onto optical projection omap
+        # Fails unless you specifying the shape_out (to be the same as what you are projecting onto)
+        # Since omap doesn't have a .shape, ocut.shape is used instead
+        if self.projected is None:
+            from reproject import reproject_interp  # slow to import, and not needed with a reprojected layer
+            with timings('reprojection'):
+                project_r, footprint = reproject_interp((rcut, rmap), imap, shape_out=icut.shape)
+
+        return Cutout(icut, imap, project_r, contours)
+
+    def contour_levels(self, ra, dec, rsize=180):
+        '''
+            Contour levels for many targets at once, one row of
+            (2^n)*(2.5*median(local_rms)) per (ra, dec) pair
+        '''
+        ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+        rpix = self.rwcs.wcs_world2pix(np.column_stack((ra, dec)), 1).astype(int)
+        if self.rms_grid is not None:
+            local_rms = self.rms_grid.lookup(rpix[:, 0] - 1, rpix[:, 1] - 1)
+        else:
+            local_rms = np.array([np.nanmedian(self.rms.cutout(pix, rsize, fill_value=np.nan, with_wcs=False)[0])
+                                  for pix in rpix])
+        return 2.5 * np.outer(local_rms, 2. ** np.arange(17))
+
+    def plot(self, cut):
+        '''
+            Draws a prepared Cutout on a new figure
+        '''
+        with self.timings('figure construction'):
+            figure = plt.figure()  # figsize=(6.55, 5.2))
+            axis = figure.add_subplot(111, projection=cut.imap)
+            # fig.subplots_adjust(left=0.25, right=.60)
+
+            axtrans = axis.get_transform(
+                'fk5')  # necessary for scattering data on later -- e.g ax.plot(data, transform=axtrans)
+
+        self.draw(axis, cut)
+        axis.set_autoscale_on(False)
+
+        return figure, axis, axtrans, cut.imap
+
+    def draw(self, axis, cut):
+        '''
+            Draws the heatmap and radio contours of a Cutout on
+            a WCSAxes already projected with cut.imap,
+            returns the image and contour set
+        '''
+        from matplotlib.colors import PowerNorm  # ,LogNorm, SymLogNorm,
+
+        #### CHANGE VMAX HERE TO SUIT YOUR DATA - (I just experimented) #####
+        # plotting
+        with self.timings('heatmap'):
+            normalise = PowerNorm(gamma=self.gamma, vmax=self.vmax)
+            image = axis.imshow(cut.image, origin='lower', cmap='gist_heat_r',
+                                norm=normalise)  # origin='lower' for .fits files
+        with self.timings('contouring'):
+            contours = axis.contour(np.arange(cut.radio.shape[0]), np.arange(cut.radio.shape[1]), cut.radio,
+                                    levels=cut.levels, linewidths=0.8)
+
+        axis.coords['RA'].set_axislabel('Right Ascension')
+        axis.coords['DEC'].set_axislabel('Declination')
+
+        return image, contours
+
+    def cutouts2(self, targetRA, targetDEC, isize=200, rsize=180):
+        '''
+            Same as cutout.cutouts2(), using the open mosaics
+        '''
+        return self.plot(self.prepare(targetRA, targetDEC, isize=isize, rsize=rsize))
+
+
+class CutoutViewer(object):
+    '''
+        Keeps one figure and WCSAxes for a whole session.
+
+        show() swaps in the image, contours and WCS of each new
+        target instead of building a new figure and window. Artists
+        drawn on top (scattered sources, markers, labels) are added
+        with add_overlay() so that clear() can remove them again.
+
+        Overlays and the title are animated: the image and contours
+        are cached as a background on every full draw, and blit()
+        redraws only the overlays on top of it, e.g. after a click.
+
+        Example usage:
+
+        viewer = CutoutViewer(engine)
+        fig, ax, axtrans, imap = viewer.show(engine.prepare(ra, dec))
+        sources, = viewer.add_overlay(*ax.plot(x, y, transform=axtrans))
+        viewer.blit()
+        viewer.clear()
+    '''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.figure = None
+        self.axis = None
+        self.image = None
+        self.contours = None
+        self.overlays = []
+        self.background = None
+        self.saving = False
+
+    def show(self, cut):
+        '''
+            Displays a prepared Cutout, creating the figure on first use,
+            returns figure, axis, axis fk5 transform and cutout wcs
+        '''
+        if self.figure is None:
+            self.figure, self.axis, axtrans, imap = self.engine.plot(cut)
+            self.image = self.axis.images[0]
+            self.contours = self.axis.collections[-1]
+            self.axis.title.set_animated(True)
+            self.figure.canvas.mpl_connect('draw_event', self._on_draw)
+            return self.figure, self.axis, axtrans, imap
+
+        self.clear()
+        self.image.remove()
+        self.contours.remove()
+        self.background = None  # stale until the next full draw
+
+        self.axis.reset_wcs(cut.imap)
+        self.image, self.contours = self.engine.draw(self.axis, cut)
+        ny, nx = cut.image.shape
+        self.axis.set_xlim(-0.5, nx - 0.5)
+        self.axis.set_ylim(-0.5, ny - 0.5)
+
+        return self.figure, self.axis, self.axis.get_transform('fk5'), cut.imap
+
+    def add_overlay(self, *artists):
+        for artist in artists:
+            artist.set_animated(True)
+        self.overlays.extend(artists)
+        return artists
+
+    def remove_overlay(self, *artists):
+        for artist in artists:
+            self.overlays.remove(artist)
+            artist.remove()
+
+    def clear(self):
+        '''
+            Removes everything drawn over the image and contours
+        '''
+        for artist in self.overlays:
+            artist.remove()
+        self.overlays = []
+
+    def _draw_animated(self):
+        for artist in self.overlays + [self.axis.title]:
+            self.figure.draw_artist(artist)
+
+    def _on_draw(self, event):
+        ''' full redraw (new target, resize): cache the background, then add the overlays '''
+        if self.saving:  # overlays are drawn as ordinary artists
+            return
+        canvas = self.figure.canvas
+        if getattr(canvas, 'supports_blit', False):
+            self.background = canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_animated()
+
+    def blit(self):
+        '''
+            Redraws the overlays and title only
+        '''
+        canvas = self.figure.canvas
+        if self.background is None:
+            canvas.draw_idle()
+            return
+        canvas.restore_region(self.background)
+        self._draw_animated()
+        canvas.blit(self.figure.bbox)
+        canvas.flush_events()
+
+    def savefig(self, *args, **kwargs):
+        '''
+            figure.savefig() including the (animated) overlays
+        '''
+        animated = self.overlays + [self.axis.title]
+        for artist in animated:
+            artist.set_animated(False)
+        self.saving = True
+        try:
+            self.figure.savefig(*args, **kwargs)
+        finally:
+            self.saving = False
+            for artist in animated:
+                artist.set_animated(True)
+            self.figure.canvas.draw_idle()
+
+
+class CutoutPrefetcher(object):
+    '''
+        Prepares cutouts for upcoming targets on background threads,
+        so moving to the next source only has to draw them.
+
+        Cutouts are keyed by the caller (e.g. (row, isize, rsize)).
+        get() returns a prefetched Cutout if one was scheduled under
+        that key, otherwise prepares it immediately.
+    '''
+
+    def __init__(self, engine, depth=3, workers=2):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.engine = engine
+        self.depth = depth
+        self.pool = ThreadPoolExecutor(max_workers=workers) if depth > 0 else None
+        self.pending = OrderedDict()  # key: future
+
+    def schedule(self, targets):
+        '''
+            targets is a list of (key, targetRA, targetDEC, isize, rsize),
+            only the first <depth> are kept, stale requests are dropped
+        '''
+        if self.pool is None:
+            return
+        targets = targets[:self.depth]
+        wanted = [t[0] for t in targets]
+
+        for key in list(self.pending):
+            if key not in wanted:
+                self.pending.pop(key).cancel()
+
+        for key, targetRA, targetDEC, isize, rsize in targets:
+            if key not in self.pending:
+                verboseprint('prefetching', key)
+                self.pending[key] = self.pool.submit(self.engine.prepare, targetRA, targetDEC, isize, rsize)
+
+    def get(self, key, targetRA, targetDEC, isize=200, rsize=180):
+        '''
+            The Cutout for key, timed as 'cutout wait' (the time the
+            session actually waits, near zero when prefetched in time)
+        '''
+        with self.engine.timings('cutout wait'):
+            future = self.pending.pop(key, None)
+            if future is not None and not future.cancelled():
+                try:
+                    return future.result()
+                except Exception as e:
+                    verboseprint('prefetch of', key, 'failed:', e)
+            return self.engine.prepare(targetRA, targetDEC, isize=isize, rsize=rsize)
+
+    def shutdown(self):
+        if self.pool is not None:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+            self.pool.shutdown(wait=False)
+
+
+def cutouts2(infrared_mosaic, radio_image, radio_rms, targetRA, targetDEC, isize=200, rsize=180, vmax=1.5,
+             verbose=False):
+    """
+    One-off cutout, opens the mosaics for this call only.
+    Use a CutoutEngine when making more than one cutout.
+
+    :param infrared_mosaic: path to the infrared mosaic
+    :param radio_image: path to the radio continuum map, shape (1,1,n,m)
+    :param radio_rms: path to the radio rms map, same shape as radio_image
+    :param targetRA: target right ascension in degrees
+    :param targetDEC: target declination in degrees
+    :param isize: infrared cutout size in pixels
+    :param rsize: radio cutout size in pixels
+    :param vmax: maximum saturation of the infrared heatmap
+    :param verbose:
+    :return: figure, axis, axis fk5 transform, cutout wcs
+    """
+    engine = CutoutEngine(infrared_mosaic, radio_image, radio_rms, vmax=vmax, rms_window=rsize, verbose=verbose)
+    try:
+        return engine.cutouts2(targetRA, targetDEC, isize=isize, rsize=rsize)
+    finally:
+        engine.close()
 
 def cutouts(infrared_mosaic, radio_image, radio_rms, targetRA, targetDEC, isize=200, rsize=180, vmax=1.5,
             verbose=False):
@@ -256,7 +868,8 @@ def cutouts(infrared_mosaic, radio_image, radio_rms, targetRA, targetDEC, isize=
     # Fails unless you specifying the shape_out (to be the same as what you are projecting onto)
     # Since omap doesn't have a .shape, ocut.shape is used instead
 
-    project_r, footprint = reproject.reproject_interp((rcut, rmap), omap, shape_out=icut.shape)
+    from reproject import reproject_interp
+    project_r, footprint = reproject_interp((rcut, rmap), omap, shape_out=icut.shape)
 
     figure = plt.figure()  # figsize=(6.55, 5.2))
     axis = figure.add_subplot(111, projection=omap)
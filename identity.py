@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# identity.py
+#
+# XID tags for mcvcm.py and the batch tools:
+#
+# 	<radio_host_ID>*<infrared_host_ID>*m<#_of_components>*C<component_#>
+#
+# Identity builds the tags for one cross-match made in the plotting
+# window, parse_tags() splits saved tags back into their fields.
+#
+# During a session the cross-match is held as integer catalogue rows by
+# CrossMatch, tags are only written out when saving or exporting.
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import numpy as np
+
+from utilities import print_center
+
+# ------------------------------------------ #
+# placeholders in the radio table's xid columns
+tag_placeholder = '-' * 53  # placeholder needs to be same length as MAX final ^XID_tag, otherwise XID_tag is truncated
+comment_placeholder = '-' * 53
+skipped_placeholder = '---crossmatch_skipped-redo_by_running_with_-x_flag---'
+
+# mcvcm_flag of provisional tags written by prematch.py, user certainties are 1--4
+auto_flag = -1
+
+# CrossMatch.core of rows that aren't cross-matched, or whose tag names
+# sources missing from the catalogues (kept verbatim in CrossMatch.unresolved)
+untagged_row, skipped_row, unresolved_row = -1, -2, -3
+
+
+class Identity(object):
+    '''
+        Handles the storage of selected source identities
+        and XID tag creation from catalogue IDs
+    '''
+    default_rad_host = ('Rnohost', -999)
+    default_inf_host = ('Inohost', -999)
+
+    def __init__(self):
+        self.inf_host = self.default_inf_host
+        self.rad_host = self.default_rad_host
+        self.components = [] #
+        self.xid_tags = [] #
+        # self.xid_positions = [] #
+        # self.comp_radecs = [] # positions of selected sources
+        # self.rad_radec = [0.,0.]
+        # self.inf_radec = [0.,0.]
+
+    def set_rad_host(self, index, ID_list):
+        self.rad_host = (ID_list[index],index)
+
+    def set_inf_host(self, index, ID_list):
+        self.inf_host = (ID_list[index],index)
+
+    def add_component(self, index, ID_list):
+        '''
+            Returns True if component was successfully added
+        '''
+        compID = (ID_list[index],index)
+        if compID in self.components or compID == self.rad_host:
+            print('Source %s has already been selected' %compID[0])
+            return False
+        else:
+            self.components.append(compID)
+            return True
+
+    def generate_tags(self):
+        '''
+        we don't need a xid_tag fot the infrared cataloge
+
+        we shouldn't get cases where there are components but no radio core
+        as in this case, the closest component should be labeled as the core
+        dec 14: I've added a catch to take the first compoenet and make it the
+        radio core automagically if this situation arises
+        '''
+        # clear xid_tags if this has already been called for some reason
+        # otherwise it will append the same tags, no bid deal but unnecessary
+        if len(self.xid_tags):
+            self.xid_tags = []
+
+        if self.rad_host == self.default_rad_host and len(self.components):
+            print_center("\n\t**** WARNING: Removed first component and used as radio core ID as this was empty ****\n")
+            self.rad_host = self.components.pop(0)
+
+        if self.rad_host == self.default_rad_host:  # yes, for when components is also empty
+            component_count = len(self.components) + 0  # catch for 'm%i' below defaulting to m1
+        else:
+            component_count = len(self.components)+1
+
+        core_ID = f'{self.rad_host[0]}*{self.inf_host[0]}*m{component_count}*C0'
+        self.xid_tags.append((core_ID,self.rad_host[1]))
+        # core_ID is attached to radio catalogue 'core' named rad_host[0]
+        # at row rad_host[1]
+
+        for c,comp in enumerate(self.components):
+            comp_ID = f'{self.rad_host[0]}*{self.inf_host[0]}*m{component_count}*C{c+1}'
+            self.xid_tags.append((comp_ID,comp[1]))
+            # core_ID is attached to radio catalogue source named comp[0]
+            # at row comp[1] - Since this is just the XID tag the combination
+            # of identical rad_host and inf_host is sufficient to associate back
+            # to the combined source in the catalogue
+
+        return self.xid_tags
+
+    def generate_rows(self):
+        '''
+            The tags of generate_tags() as catalogue rows, for CrossMatch.set()
+
+            Returns the radio rows tagged, and the radio core row, infrared
+            host row (-1 for no host), component count and component number
+            of each. Nothing is returned if no radio source was picked.
+        '''
+        self.generate_tags()
+        if self.rad_host == self.default_rad_host:
+            print('No radio source selected, nothing to tag')
+            return (np.array([], dtype=int),) * 5
+
+        rows = np.array([row for tag, row in self.xid_tags], dtype=int)
+        host = -1 if self.inf_host == self.default_inf_host else self.inf_host[1]
+        return (rows, np.full(len(rows), self.rad_host[1]), np.full(len(rows), host),
+                np.full(len(rows), len(rows)), np.arange(len(rows)))
+
+
+class CrossMatch(object):
+    '''
+        The cross-match of every radio catalogue row, as compact arrays:
+
+            core  - radio row of the source's core (or untagged_row,
+                    skipped_row, unresolved_row)
+            host  - infrared row of the source's host, -1 for no host
+            ncomp - number of radio components in the source
+            comp  - component number of the row, 0 for the core
+            flag  - certainty 1--4, or auto_flag for provisional matches
+
+        Comments are kept sparsely by row. tags() and comments() write
+        the xid columns out for saving, all at once.
+
+        Example usage:
+
+        xmatch = CrossMatch(rTable['ID'], iTable['ID'])
+        xmatch.set(*ident.generate_rows(), flag=2, comment='bent tails')
+        xmatch.tags(rows)
+    '''
+    default_inf_host = Identity.default_inf_host
+
+    def __init__(self, rad_ids, inf_ids):
+        self.rad_ids = rad_ids
+        self.inf_ids = inf_ids
+        self.core = np.full(len(rad_ids), untagged_row, dtype=np.int32)
+        self.host = np.full(len(rad_ids), -1, dtype=np.int32)
+        self.ncomp = np.zeros(len(rad_ids), dtype=np.int16)
+        self.comp = np.zeros(len(rad_ids), dtype=np.int16)
+        self.flag = np.zeros(len(rad_ids), dtype=np.int8)
+        self.comment = {}
+        self.unresolved = {}
+        self._sorted = {}  # argsort of each ID column, made on first lookup
+
+    def __len__(self):
+        return len(self.core)
+
+    def tagged(self):
+        ''' True for every row that is cross-matched '''
+        return (self.core >= 0) | (self.core == unresolved_row)
+
+    def recorded(self):
+        ''' True for every row with something to save (cross-matched or skipped) '''
+        return self.core != untagged_row
+
+    def rows(self, ids, catalogue='radio'):
+        '''
+            Catalogue rows of ids (-1 where missing), by a sorted-key
+            join against the radio or infrared IDs
+        '''
+        from session import lookup_rows
+
+        if catalogue not in self._sorted:
+            keys = np.asarray(self.rad_ids if catalogue == 'radio' else self.inf_ids).astype(str)
+            self._sorted[catalogue] = (keys, np.argsort(keys, kind='stable'))
+        keys, order = self._sorted[catalogue]
+        return lookup_rows(keys, ids, order=order)
+
+    def set(self, rows, core, host, ncomp, comp, flag, comment=None):
+        '''
+            Cross-matches rows, as made by Identity.generate_rows()
+        '''
+        self.core[rows], self.host[rows] = core, host
+        self.ncomp[rows], self.comp[rows], self.flag[rows] = ncomp, comp, int(flag)
+        for row in np.atleast_1d(rows).tolist():
+            self.unresolved.pop(row, None)
+            if comment:
+                self.comment[row] = str(comment)
+            elif comment is not None:
+                self.comment.pop(row, None)
+
+    def skip(self, rows):
+        ''' marks rows to be cross-matched later (with -x) '''
+        self.core[rows] = skipped_row
+        for row in np.atleast_1d(rows).tolist():
+            self.unresolved.pop(row, None)
+
+    def set_tags(self, rows, tags, flags, comments):
+        '''
+            Reads saved xid columns (tag strings) into rows, all at once
+        '''
+        rows = np.asarray(rows, dtype=int)
+        tags = np.asarray(tags).astype(str)
+        done = is_tagged(tags)
+
+        core = np.where(tags == skipped_placeholder, skipped_row, untagged_row)
+        host = np.full(len(rows), -1)
+        ncomp, comp = np.zeros(len(rows), dtype=int), np.zeros(len(rows), dtype=int)
+        rad_host, inf_host, ncomp[done], comp[done] = parse_tags(tags[done])
+        core[done] = self.rows(rad_host)
+        host[done] = self.rows(inf_host, catalogue='infrared')
+        lost = done.copy()
+        lost[done] = (core[done] < 0) | ((host[done] < 0) & (inf_host != self.default_inf_host[0]))
+        core[lost] = unresolved_row
+
+        self.core[rows], self.host[rows] = core, host
+        self.ncomp[rows], self.comp[rows], self.flag[rows] = ncomp, comp, flags
+        for row, tag, is_lost, comment in zip(rows.tolist(), tags, lost, np.asarray(comments).astype(str)):
+            if is_lost:
+                self.unresolved[row] = str(tag)
+            else:
+                self.unresolved.pop(row, None)
+            if comment and comment != comment_placeholder:
+                self.comment[row] = str(comment)
+            else:
+                self.comment.pop(row, None)
+
+    def tags(self, rows=slice(None)):
+        '''
+            The xid tags of rows, written from the row arrays all at once
+        '''
+        rows = np.arange(len(self))[rows]
+        core, host = self.core[rows], self.host[rows]
+        done = core >= 0
+
+        rad = np.asarray(self.rad_ids)[core[done]].astype(str)
+        inf = np.where(host[done] >= 0, np.asarray(self.inf_ids)[np.maximum(host[done], 0)].astype(str),
+                       self.default_inf_host[0])
+        made = np.char.add(np.char.add(np.char.add(rad, '*'), inf), '*m')
+        made = np.char.add(np.char.add(np.char.add(made, self.ncomp[rows][done].astype(str)), '*C'),
+                           self.comp[rows][done].astype(str))
+
+        lost = [self.unresolved[row] for row in rows[core == unresolved_row]]
+        width = max([len(tag_placeholder), made.dtype.itemsize // 4] + [len(tag) for tag in lost])
+        tags = np.where(core == skipped_row, skipped_placeholder, tag_placeholder).astype(f'U{width}')
+        tags[done] = made
+        tags[core == unresolved_row] = lost
+        return tags
+
+    def comments(self, rows=slice(None)):
+        ''' the comments of rows, comment_placeholder where there are none '''
+        rows = np.arange(len(self))[rows]
+        comments = np.full(len(rows), comment_placeholder, dtype=object)
+        if self.comment:
+            where = np.flatnonzero(np.isin(rows, np.fromiter(self.comment, dtype=int, count=len(self.comment))))
+            comments[where] = [self.comment[row] for row in rows[where].tolist()]
+        return comments.astype(str)
+
+
+def is_tagged(tags):
+    '''
+        True for every tag that is a real cross-match
+        (not a placeholder or skipped source)
+    '''
+    tags = np.asarray(tags).astype(str)
+    return (tags != tag_placeholder) & (tags != skipped_placeholder)
+
+
+def parse_tags(tags):
+    '''
+        Splits an array of xid tags into their fields, all at once
+
+        Returns arrays of radio host ID, infrared host ID,
+        number of components and component number
+    '''
+    tags = np.asarray(tags).astype(str)
+    if len(tags) == 0:
+        empty = np.array([], dtype=str)
+        return empty, empty, np.array([], dtype=int), np.array([], dtype=int)
+
+    fields = np.array(np.char.split(tags, '*').tolist(), dtype=str)
+    rad_host, inf_host = fields[:, 0], fields[:, 1]
+    component_count = np.char.lstrip(fields[:, 2], 'm').astype(int)
+    component = np.char.lstrip(fields[:, 3], 'C').astype(int)
+    return rad_host, inf_host, component_count, component
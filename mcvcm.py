@@ -52,23 +52,19 @@
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 from __future__ import print_function
 
-import matplotlib
-
-matplotlib.use("TkAgg") # necessary for use with tkinter
-
-import numpy as np
-import matplotlib.pyplot as plt
+# only what argument parsing needs is imported up front, so -h and argument
+# errors are instant; matplotlib, numpy, astropy etc. follow once args are valid
 import argparse
 import textwrap
-from utilities import *
-from tkComment import tkComment
 import json
 import os
+import time
 
 thisdir = os.path.dirname(os.path.abspath(__file__))
 
 def runtkc():
     global tkC
+    from tkComment import tkComment  # Tk is only needed once a comment is made
     tkC = tkComment()
     tkC.root.mainloop()
 
@@ -97,8 +93,8 @@ parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
             ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
             '''))
 parser.add_argument('-v', help='toggles verbose output',action="store_true", default=False)
-parser.add_argument('-t', help='toggles output of function timings (requires verbose mode)', action='store_true',
-                    default=False)
+parser.add_argument('-t', help='times each stage of the session, and reports percentiles when quitting',
+                    action='store_true', default=False)
 parser.add_argument('-x', help='if specified, processes only sources marked as \'tricky\'', action='store_true',
                     default=False)
 parser.add_argument('-d', help='if specified, does a dummy demo dose of \'dentification', action='store_true',
@@ -117,6 +113,25 @@ timeon = args.t
 trickyon = args.x
 doing_demo = args.d
 
+from utilities import *
+
+# check the field's files before the slow imports, rather than failing after them
+missing_files = [f'{key}: {path}' for key, path in field_paths(thisdir, field).items() if not os.path.isfile(path)]
+if missing_files:
+    parser.error('files in path_config.json not found:\n  ' + '\n  '.join(missing_files))
+
+print('Loading libraries ...', flush=True)
+import matplotlib
+
+matplotlib.use("TkAgg") # necessary for use with tkinter
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+# keys used by on_key() that matplotlib binds by default (grid toggles fail on WCSAxes)
+for keymap, key in (('keymap.grid', 'g'), ('keymap.grid_minor', 'G')):
+    plt.rcParams[keymap] = [bound for bound in plt.rcParams[keymap] if bound != key]
+
 
 def verbwrap(function):
     def wrapper(*args, **kwargs):
@@ -144,88 +159,17 @@ if verbose:
 else:
     verboseprint = lambda *a: None	 # do nothing
 
+# per-stage timings, reported at quit with -t (records nothing otherwise)
+timings = Timings(enabled=timeon)
+
 
 # ****************************************** #
 # 		The nitty gritty of the program
 # ****************************************** #
 
 
-class Identity(object):
-    '''
-        Handles the storage of selected source identities
-        and XID tag creation from catalogue IDs
-    '''
-    default_rad_host = ('Rnohost', -999)
-    default_inf_host = ('Inohost', -999)
-
-    def __init__(self):
-        self.inf_host = self.default_inf_host
-        self.rad_host = self.default_rad_host
-        self.components = [] #
-        self.xid_tags = [] #
-        # self.xid_positions = [] #
-        # self.comp_radecs = [] # positions of selected sources
-        # self.rad_radec = [0.,0.]
-        # self.inf_radec = [0.,0.]
-
-    def set_rad_host(self, index, ID_list):
-        self.rad_host = (ID_list[index],index)
-
-    def set_inf_host(self, index, ID_list):
-        self.inf_host = (ID_list[index],index)
-
-    def add_component(self, index, ID_list):
-        '''
-            Returns True if component was successfully added
-        '''
-        compID = (ID_list[index],index)
-        if compID in self.components or compID == self.rad_host:
-            print('Source %s has already been selected' %compID[0])
-            return False
-        else:
-            self.components.append(compID)
-            return True
-
-    def generate_tags(self):
-        '''
-        we don't need a xid_tag fot the infrared cataloge
-
-        we shouldn't get cases where there are components but no radio core
-        as in this case, the closest component should be labeled as the core
-        dec 14: I've added a catch to take the first compoenet and make it the
-        radio core automagically if this situation arises
-        '''
-        # clear xid_tags if this has already been called for some reason
-        # otherwise it will append the same tags, no bid deal but unnecessary
-        if len(self.xid_tags):
-            self.xid_tags = []
-
-        if self.rad_host == self.default_rad_host and len(self.components):
-            print_center("\n\t**** WARNING: Removed first component and used as radio core ID as this was empty ****\n")
-            self.rad_host = self.components.pop(0)
-
-        if self.rad_host == self.default_rad_host:  # yes, for when components is also empty
-            component_count = len(self.components) + 0  # catch for 'm%i' below defaulting to m1
-        else:
-            component_count = len(self.components)+1
-
-        core_ID = f'{self.rad_host[0]}*{self.inf_host[0]}*m{component_count}*C0'
-        self.xid_tags.append((core_ID,self.rad_host[1]))
-        # core_ID is attached to radio catalogue 'core' named rad_host[0]
-        # at row rad_host[1]
-
-        for c,comp in enumerate(self.components):
-            comp_ID = f'{self.rad_host[0]}*{self.inf_host[0]}*m{component_count}*C{c+1}'
-            self.xid_tags.append((comp_ID,comp[1]))
-            # core_ID is attached to radio catalogue source named comp[0]
-            # at row comp[1] - Since this is just the XID tag the combination
-            # of identical rad_host and inf_host is sufficient to associate back
-            # to the combined source in the catalogue
-
-        return self.xid_tags
-
-
 # ------------------------------------------ #
+@timings.timed('pick')
 @verbwrap
 def onpick(event):
     '''
@@ -244,42 +188,60 @@ def onpick(event):
         selection = event.artist
         xdata = selection.get_xdata()
         ydata = selection.get_ydata()
-        ind = event.ind
-        point = tuple(zip(xdata[ind], ydata[ind]))
-        xclick,yclick = point[0] # RA,dec = point[0]
+        ind = event.ind[0]  # index into the plotted subset (iData or rData)
+        xclick, yclick = xdata[ind], ydata[ind]  # RA,dec
 
-        print('RA, Dec click:', point[0])
+        print('RA, Dec click:', (xclick, yclick))
 
         if phase == 1:
             ''' Marking infrared host '''
             label = 'ihost'
-            ident.set_inf_host((np.where((iTable[iRA_column] == xclick) & (iTable[iDEC_column] == yclick)))[0][0],
-                               iTable[iID_column])
+            ident.set_inf_host(int(iRows[ind]), iTable[iID_column])
+            if iDisplay_columns:
+                print('Infrared host:', iTable[iID_column][iRows[ind]],
+                      *[f'{name}={iTable[name][iRows[ind]]}' for name in iDisplay_columns])
             xpix,ypix = wcsmap.wcs_world2pix([[xclick,yclick]],1)[0]
             icross = Crosshair(xpix,ypix,ax,linewidth=1.5)
+            viewer.add_overlay(icross.hline, icross.vline)
         if phase == 2:
             ''' Marking radio host '''
             label = 'rhost'
             mark, col, size = 'D', 'green', 16
-            ident.set_rad_host((np.where((rTable[rRA_column] == xclick) & (rTable[rDEC_column] == yclick)))[0][0],
-                               rTable[rID_column])
-            ax.plot(xclick, yclick, mark, markersize=size, mfc='none', mec=col, mew=1.2,linewidth=2, transform=axtrans)
+            ident.set_rad_host(int(rRows[ind]), rTable[rID_column])
+            viewer.add_overlay(*ax.plot(xclick, yclick, mark, markersize=size, mfc='none', mec=col, mew=1.2,
+                                        linewidth=2, transform=axtrans))
         if phase == 3:
             ''' Marking radio components '''
             label = 'C%i' % (len(ident.components))
-            mark, col, size = 's', 'limegreen', 16
-            added = ident.add_component(
-                    (np.where((rTable[rRA_column] == xclick) & (rTable[rDEC_column] == yclick)))[0][0],
-                    rTable[rID_column])
+            added = ident.add_component(int(rRows[ind]), rTable[rID_column])
             if added:
-                ax.text(xclick, yclick,  ' - %s' % (label), horizontalalignment='left', transform=axtrans)
-                ax.plot(xclick, yclick, mark, markersize=size, mfc='none', mec=col, mew=1.2,linewidth=2, transform=axtrans)
+                mark_component(label, xclick, yclick)
 
         verboseprint('[xclick,yclick,label]=',xclick,yclick,label)
 
-        fig.canvas.draw_idle()
+        viewer.blit()
+
+def mark_component(label, ra, dec):
+    '''
+        draws a selected radio component and its label
+    '''
+    mark, col, size = 's', 'limegreen', 16
+    viewer.add_overlay(ax.text(ra, dec,  ' - %s' % (label), horizontalalignment='left', transform=axtrans))
+    viewer.add_overlay(*ax.plot(ra, dec, mark, markersize=size, mfc='none', mec=col, mew=1.2,
+                                linewidth=2, transform=axtrans))
+
+
+def group_members(row):
+    '''
+        rows in the same friends-of-friends group as row (including it)
+    '''
+    group = rTable['mcvcm_group'][row]
+    lo, hi = np.searchsorted(ordered_groups, group, 'left'), np.searchsorted(ordered_groups, group, 'right')
+    return group_order[lo:hi]
+
 
 # ------------------------------------------ #
+@timings.timed('key press')
 @verbwrap
 def on_key(event):
     '''
@@ -287,7 +249,7 @@ def on_key(event):
     '''
     global phase
     global ipix_current, rpix_current
-    global quitting, newtarget
+    global quitting, newtarget, jump_row
     global keyID
     global certainty
     global tkC
@@ -318,6 +280,7 @@ def on_key(event):
             # print('comment for this source:', tkC.entryVar.get())
             # # except (AttributeError, NameError) as e:
             # # 	pass
+            next_source()
             return None
         else: print('You\'re not done yet')
 
@@ -329,11 +292,33 @@ def on_key(event):
         except ValueError as e:
             pass
 
+    if event.key == 'g' and phase == 3:
+        ''' add the rest of the target's group as components '''
+        for row in group_members(target_index):
+            label = 'C%i' % (len(ident.components))
+            if row != ident.rad_host[1] and ident.add_component(int(row), rTable[rID_column]):
+                mark_component(label, rTable[rRA_column][row], rTable[rDEC_column][row])
+        viewer.blit()
+
+    if event.key == 'G':
+        ''' go to a source by ID or row number '''
+        wanted = input('Go to source (ID or row number): ')
+        row = queue.find(wanted, xmatch)
+        if row is None:
+            print(f'No source {wanted}')
+        else:
+            jump_row = row
+            cleanup()
+            newtarget = True
+            next_source()
+        return None
+
     if event.key == 'X':
         ''' Mark for reexamination later, move to next source '''
         tricky_tag()
         cleanup()
         newtarget = True
+        next_source()
         return None
 
     if event.key == 'Q':
@@ -341,6 +326,7 @@ def on_key(event):
         update_table()
         cleanup()
         quitting = True
+        plt.close(fig)
         return None
 
     if event.key == 'r':
@@ -348,6 +334,7 @@ def on_key(event):
         ipix_current, rpix_current = ipix_default, rpix_default  # reset cutout size
         cleanup()
         newtarget = False # not explicitly necessary
+        next_source()
         return None
 
     if event.key == 'b':
@@ -356,12 +343,13 @@ def on_key(event):
         rpix_current = int(rpix_current * 1.4)  # increase cutout size
         cleanup()
         newtarget = False # not explicitly necessary
+        next_source()
         return None
 
     if event.key == 't':
         ''' toggles visibility of scattered sources '''
         sources.set_visible(not sources.get_visible())
-        fig.canvas.draw_idle()
+        viewer.blit()
 
     if event.key == 'S':
         ''' Save progress of IDs to file'''
@@ -384,11 +372,15 @@ def on_key(event):
         ''' Manually save figure '''
         ID = rTable[rID_column][target_index]
         save_fig(ID+'_manual', manual = True)
+        # restart ID, as with the original per-source windows
+        cleanup()
+        newtarget = False
+        next_source()
 
     if event.key == 'i':
         ''' print lst 25 id'd sources (from table) '''
         print('Last 25 IDs')
-        print(rTable[rTable['mcvcm_tag'] != tag_placeholder][-25:])
+        print(session.xid_table(rTable, xmatch, np.flatnonzero(xmatch.recorded())[-25:]))
 
     if event.key == 'J':
         ''' print lst 25 id'd sources (from table) '''
@@ -409,8 +401,10 @@ def on_key(event):
         print('\ti - show last 25 rows from ID\'d table')
         print('\tb - zoom out (can be pressed multiple times)')
         print('\tt - toggle catalogue sources on/off')
+        print('\tg - add the rest of the group (circled) as components, in the component phase')
         print('\tf - manually save figure')
         print('\tr - restart ID of current source')
+        print('\tshift+g - go to a source by ID or row number (asked for in the terminal)')
         print('\tshift+q - save table to file, and quit')
         print('\tshift+s - save table to file')
         print('\tshift+x - mark for reexamination later\n\t\tRun script with -x flag to display only these')
@@ -418,23 +412,30 @@ def on_key(event):
         print('...............................')
 
 # ------------------------------------------ #
+@timings.timed('update_table')
 @verbwrap
 def update_table(whole_table=False):
     '''
         Saves the id'd objects to a file
+
+        Tags are already safe in the session store as soon as they are made,
+        this writes the fixed width table and compacts the store
     '''
+    sync_store()
+    tagged = np.flatnonzero(xmatch.recorded())
     if whole_table:
         verboseprint('Saving entire table, this may take a while ...')
-        rsave = rTable
+        rsave = session.xid_table(rTable, xmatch)
     else:
         verboseprint('Saving table of ID\'d objects only ...')
-        rsave = rTable[rTable['mcvcm_tag'] != tag_placeholder]
+        rsave = session.xid_table(rTable, xmatch, tagged)
 
     if len(rsave) == 0:
         print('No data to save!')
     else:
         verboseprint('Saving radio table ...')
-        ascii.write(rsave, save_path, format='fixed_width_two_line', overwrite=True)
+        session.write_table(rsave, save_path)
+        store.compact(session.table_records(xmatch, tagged))
         verboseprint('Saved!')
 
 # ------------------------------------------ #
@@ -446,20 +447,19 @@ def tag_generator():
     '''
     global ident, tkC
 
-    ident.generate_tags()
-
+    rows, core, host, ncomp, comp = ident.generate_rows()
     for tag in ident.xid_tags:
-        verboseprint('Writing to table')
         verboseprint('current XID tag:', tag[0])
         verboseprint('from radio catalogue row:', tag[1])
 
-        rTable['mcvcm_tag'][tag[1]] = tag[0]
-        rTable['mcvcm_flag'][tag[1]] = certainty
+    try:
+        comment = tkC.entryVar.get()
+    except (AttributeError, NameError) as E:
+        comment = None  # comment remains as placeholder value
+    xmatch.set(rows, core, host, ncomp, comp, certainty, comment)
 
-        try:
-            rTable['mcvcm_comment'][tag[1]] = tkC.entryVar.get()
-        except (AttributeError, NameError) as E:
-            pass  # comment remains as placeholder value
+    store.append(session.table_records(xmatch, rows))
+    queue.set_status(rows, session.match_status(xmatch, rows))
 
 
 # ------------------------------------------ #
@@ -472,7 +472,11 @@ def tricky_tag():
         run script with -x flag to ID only these
     '''
     source = target_index
-    rTable['mcvcm_tag'][source] = skipped_placeholder
+    xmatch.skip([source])
+    store.append(session.table_records(xmatch, [source]))
+    queue.set_status([source], session.skipped)
+    if trickyon:
+        queue.defer([source])  # still skipped, but not served again until the next -x session
 
 
 # ------------------------------------------ #
@@ -487,29 +491,111 @@ def next_phase():
 
     if phase == 1:
         # Switch to radio host tags/data
-        sources.remove()
-        sources, = ax.plot(rData[rRA_column], rData[rDEC_column], picker=6, transform=axtrans, linestyle='none',
-                           **parameter_config['markers']['phase2'])
+        viewer.remove_overlay(sources)
+        sources, = viewer.add_overlay(*ax.plot(rData[rRA_column], rData[rDEC_column], picker=6, transform=axtrans,
+                                               linestyle='none', **parameter_config['markers']['phase2']))
         phase_title = 'Radio core ID'
         ax.set_title(phase_title)
-        fig.canvas.draw_idle()
+        viewer.blit()
     if phase == 2:
         # Switch to radio comp tags
-        sources.remove()
-        sources, = ax.plot(rData[rRA_column], rData[rDEC_column], picker=6, transform=axtrans, linestyle='none',
-                           **parameter_config['markers']['phase3'])
+        viewer.remove_overlay(sources)
+        sources, = viewer.add_overlay(*ax.plot(rData[rRA_column], rData[rDEC_column], picker=6, transform=axtrans,
+                                               linestyle='none', **parameter_config['markers']['phase3']))
         phase_title = 'Radio component IDs'
         ax.set_title(phase_title)
-        fig.canvas.draw_idle()
+        viewer.blit()
     phase += 1
 
+# ------------------------------------------ #
+@verbwrap
+def preselect_auto():
+    '''
+        marks the provisional infrared and radio hosts of the target,
+        and moves on to radio component selection
+    '''
+    global icross, preselected_row
+
+    preselected_row = target_index
+    host = int(xmatch.host[target_index])
+    print(f'Provisional match: {xmatch.tags([target_index])[0]}')
+    print('press enter to confirm (with a certainty 1-4), add components, or r to redo by hand')
+
+    if host >= 0:
+        ident.set_inf_host(host, iTable[iID_column])
+        xpix, ypix = wcsmap.wcs_world2pix([[iTable[iRA_column][host], iTable[iDEC_column][host]]], 1)[0]
+        icross = Crosshair(xpix, ypix, ax, linewidth=1.5)
+        viewer.add_overlay(icross.hline, icross.vline)
+    ident.set_rad_host(target_index, rTable[rID_column])
+    viewer.add_overlay(*ax.plot(rTable[rRA_column][target_index], rTable[rDEC_column][target_index], 'D',
+                                markersize=16, mfc='none', mec='green', mew=1.2, linewidth=2, transform=axtrans))
+    next_phase()
+    next_phase()
+
+
+# ------------------------------------------ #
+def build_queue():
+    '''
+        queues the rows this session still has to identify (untagged,
+        or marked tricky when running with -x, plus provisional matches
+        with prematch confirm on), in the configured target_order
+    '''
+    global queue
+
+    if trickyon:
+        pending = (session.skipped,)
+    elif confirm_auto:
+        pending = (session.untagged, session.auto)
+    else:
+        pending = (session.untagged,)
+    # kept with the session's table, so resuming serves targets in the same order
+    order = session.stored_order(os.path.splitext(save_path)[0], target_ordering, rTable,
+                                 parameter_config['column_names'], radio_catalogue,
+                                 linking_arcsec=parameter_config['grouping']['linking_arcsec'])
+    queue = session.TargetQueue(order, session.match_status(xmatch), pending)
+    if start_index is not None and start_index < len(rTable):
+        queue.jump(start_index)  # the queue wraps, so rows before it in the order are served later
+    print(f'{len(queue)} of {len(rTable)} sources to cross-match ({target_ordering} order)')
+
+
+def upcoming_targets(count):
+    '''
+        rows that get_target() will pick after the current target,
+        assuming nothing else is tagged in the meantime
+    '''
+    return queue.upcoming(count)
+
+
+def prefetch_upcoming():
+    '''
+        queues cutouts of the next few targets (at default size)
+        to be prepared in the background
+    '''
+    targets = []
+    for row in upcoming_targets(prefetcher.depth):
+        targets.append(((row, ipix_default, rpix_default),
+                        rTable[rRA_column][row], rTable[rDEC_column][row], ipix_default, rpix_default))
+    prefetcher.schedule(targets)
+
+
+def sync_store():
+    '''
+        copies tags written by other annotators (sqlite backend) into xmatch
+    '''
+    count, missing = session.apply_records(xmatch, store.sync())
+    if count:
+        print(f'Picked up {count} tags from other annotators')
+        queue.set_status(slice(None), session.match_status(xmatch))
+        queue.rebuild()
+
+
 # ------------------------------------------ #
 @verbwrap
 def get_target():
     '''
         handles incrementation of source to be ID'd
     '''
-    global target_index
+    global target_index, jump_row
     global ipix_current, rpix_current
     global newtarget
 
@@ -520,72 +606,84 @@ def get_target():
 
     ipix_current, rpix_current = ipix_default, rpix_default  # reset cutout size
 
-    # save on every 5th ID
-    print('Autosaving ... ')
-    if not target_index%5:
-        update_table()
-
     verboseprint('target_index =', target_index)
-    skips = 0
 
-    if trickyon:
-        while newtarget:
-            if target_index != len(rTable) and rTable['mcvcm_tag'][target_index] != skipped_placeholder:
-                ''' skip all sources with good (or no) ID '''
-                verboseprint('Good (or no) ID for row', target_index,
-                             '(%s: %s)' % (rTable[rID_column][target_index], rTable['mcvcm_tag'][target_index]))
-                skips+=1
-                target_index+=1
-            else:
-                newtarget=False
-        verboseprint('Skipped %i sources with good (or no) IDs' %(skips), 'tindx',target_index)
-    else:
-        while newtarget:
-            if target_index != len(rTable) and rTable['mcvcm_tag'][target_index] != tag_placeholder:
-                ''' skip identifying sources already tagged '''
-                verboseprint('Already ID\'d row', target_index,
-                             '(%s: %s)' % (rTable[rID_column][target_index], rTable['mcvcm_tag'][target_index]))
-                skips+=1
-                target_index+=1
-            else:
-                newtarget=False
-        verboseprint('Skipped %i sources already tagged' %(skips))
+    # hand back the previous target and pick up anything tagged by other annotators
+    if target_index != len(rTable):
+        store.release(str(rTable[rID_column][target_index]))
+    sync_store()
+
+    if jump_row is not None:
+        # a source asked for with 'G' is shown whatever its status, the queue carries on after it
+        target_index, jump_row = jump_row, None
+        queue.jump(target_index)
+        if not store.lease(str(rTable[rID_column][target_index])):
+            print('WARNING: another annotator holds the lease on this source')
+        newtarget = False
+
+    elif viewer.figure is not None and queue.current() == target_index:
+        queue.next()  # the target just shown is still pending (e.g. skipped again with -x), move past it
+
+    waiting = False
+    while newtarget:
+        row, held = queue.serve(lambda row: store.lease(str(rTable[rID_column][row])))
+        if row is not None:
+            target_index = row
+            newtarget=False
+        elif held:
+            # not done: the sources left are being worked on, wait for them to be tagged or their leases to lapse
+            if not waiting:
+                print(f'The {len(queue)} sources left are leased by other annotators, waiting for them ...')
+                waiting = True
+            time.sleep(lease_wait)
+            sync_store()
+        else:
+            target_index = len(rTable)
+            newtarget=False
 
     print('New target: row', target_index)
 
 
 # ------------------------------------------ #
+@timings.timed('check_save')
 @verbwrap
 def check_save():
     '''
-        checks if (in a previous xid run) a file was saved,
+        checks if (in a previous xid run) a session store or file was saved,
         and if so adds those IDs to current list so they
         don't have to be repeated.
 
         Assumes previous xid run used the same save_path
 
-        Work is always saved to the core (un-numbered) file,
-        this is backed up to a numbered file each time this
+        The store is replayed when present (no table parse needed),
+        otherwise IDs are recovered from the table itself.
+        Work is always saved to the core (un-numbered) files,
+        these are backed up to numbered files each time this
         script is run.
     '''
     global rTable
     count = 0
-
-    if file_accessible(save_path):
+    missing = []
+
+    if store.exists():
+        store.backup()
+        count, missing = session.apply_records(xmatch, store.replay())
+        if count:
+            # start this session's journal from a clean copy of what was recovered
+            store.compact(session.table_records(xmatch, np.flatnonzero(xmatch.recorded())))
+    elif file_accessible(save_path):
         version_control(save_path)
         saved_table = ascii.read(save_path)
-        for row in saved_table:
-            count +=1
-            source, xid, flag, comment = row[rID_column], row['mcvcm_tag'], row['mcvcm_flag'], row['mcvcm_comment']
 
-            # attach this xid to appropriate source in new table
-            newRow = np.where(rTable[rID_column] == source)[0][0]
-            rTable[newRow]['mcvcm_tag'] = xid
-            rTable[newRow]['mcvcm_flag'] = flag
-            rTable[newRow]['mcvcm_comment'] = comment
+        # attach these xids to the matching sources in new table
+        count, missing = session.merge_saved(xmatch, saved_table, rID_column)
+        if count:
+            # the store is replayed in preference to the table from now on
+            store.append(session.table_records(xmatch, np.flatnonzero(xmatch.recorded())))
 
-            verboseprint('Already ID\'d %s as %s' %(source,xid))
-            verboseprint('adding to row %i of current table' %(newRow))
+    if len(missing):
+        print(f'WARNING: {len(missing)} saved IDs are not in the current radio catalogue and were not recovered:')
+        print(', '.join(str(source) for source in missing))
 
     verboseprint('\nrecovered %i IDs from previous session' %count)
 
@@ -614,10 +712,8 @@ def save_fig(rID, manual = False):
             filename = name+extention
 
         save = os.path.join(fig_path, filename)
-        fig.savefig(save, bbox_inches='tight', dpi = 300)
+        viewer.savefig(save, bbox_inches='tight', dpi = 300)
         verboseprint('Saved' , filename)
-        if manual: # restart ID as sources are now removed
-            cleanup()
 
 
 # ------------------------------------------ #
@@ -626,17 +722,12 @@ def cleanup():
     '''
         cleans before restart,
         or next source
+
+        the figure, window and event connections are kept,
+        only the markers and scattered sources are removed
     '''
-    global fig, ax, axtrans, sources
-    global keyID, clickID, tkC
-    fig.canvas.mpl_disconnect(keyID)
-    fig.canvas.mpl_disconnect(clickID)
-    plt.close(fig)
-    del(fig)
-    del(ax)
-    del(sources)
-    del(keyID)
-    del(clickID)
+    global tkC
+    viewer.clear()
     try:
         del(tkC)
     except NameError:
@@ -644,6 +735,19 @@ def cleanup():
 
 
 # ------------------------------------------ #
+def next_source():
+    '''
+        draws the next target (or the current one again,
+        after r/b/f) in the session's window
+    '''
+    get_target()
+    start()
+    if quitting and viewer.figure is not None:
+        plt.close(viewer.figure)
+
+
+# ------------------------------------------ #
+@timings.timed('target display')
 @verbwrap
 def start():
     '''
@@ -656,7 +760,7 @@ def start():
     global fig, ax, axtrans, sources, phase_title, wcsmap
     global clicks
     global keyID, clickID
-    global iData, rData
+    global iData, rData, iRows, rRows
     global ipix_current, rpix_current
     global quitting
     global ident, certainty
@@ -680,32 +784,57 @@ def start():
         quitting = True
         return None
 
+    # renew the lease on this target (sqlite backend) for restarts/zooms on slow sources
+    if not store.lease(str(rTable[rID_column][target_index])):
+        print('WARNING: the lease on this source has expired and another annotator has taken it')
+
     # Get coordinates of radio target
     tRA, tDEC = rTable[rRA_column][target_index], rTable[rDEC_column][target_index]
     verboseprint('target RA,Dec = ', tRA, tDEC)
-    target = SkyCoord(tRA, tDEC, frame='fk5', unit='deg')
 
-    # Grab figure, axis object, and axis transform from cutoutslink.py
-    fig, ax, axtrans, wcsmap = cutout.cutouts2(mosaic, radioSB, radioRMS, tRA, tDEC,
-                                               isize=ipix_current, rsize=rpix_current, verbose=verbose)
+    # Grab the (ideally prefetched) cutout, and show it in the session's figure
+    cut = prefetcher.get((target_index, ipix_current, rpix_current), tRA, tDEC,
+                         isize=ipix_current, rsize=rpix_current)
+    first_show = viewer.figure is None
+    fig, ax, axtrans, wcsmap = viewer.show(cut)
+    prefetch_upcoming()
     ax.set_title(phase_title)
-    fig.canvas.draw_idle()
 
     # select catalogue sources from a region around target to mininimise plotting time
-    iData = iTable[iCoords.separation(target) < 240 * u.arcsec]
-    rData = rTable[rCoords.separation(target) < 240 * u.arcsec]
+    # the region grows with the cutout when zoomed out with 'b'
+    radius = neighbour_radius * ipix_current / ipix_default
+    # iRows/rRows map a plotted point (event.ind) back to its catalogue row
+    iRows = iIndex.query(tRA, tDEC, radius)
+    rRows = rIndex.query(tRA, tDEC, radius)
+    iData = iTable[iRows]
+    rData = rTable[rRows]
 
     # plot sources and assign for deletion later (comma is essential to deletion!)
-    sources, = ax.plot(iData[iRA_column], iData[iDEC_column], picker=6, transform=axtrans, linestyle='none',
-                       **parameter_config['markers']['phase1'])
-
-    # Start canvas listeners
-    keyID = fig.canvas.mpl_connect('key_press_event', on_key)
-    clickID = fig.canvas.mpl_connect('pick_event', onpick)
-
-    plt.subplots_adjust(left=0.05, right=0.9, top=0.9, bottom=0.1)
-    plt.get_current_fig_manager().window.wm_geometry(f"+{figure_pos_horizontal}+{figure_pos_vertical}")
-    plt.show()
+    sources, = viewer.add_overlay(*ax.plot(iData[iRA_column], iData[iDEC_column], picker=6, transform=axtrans,
+                                           linestyle='none', **parameter_config['markers']['phase1']))
+
+    # the rest of the target's friends-of-friends group are likely components
+    members = group_members(target_index)
+    others = members[members != target_index]
+    if len(others):
+        print(f'Group of {len(members)} sources:', *rTable[rID_column][members], '(press g to add them as components)')
+        viewer.add_overlay(*ax.plot(rTable[rRA_column][others], rTable[rDEC_column][others], 'o', markersize=14,
+                                    mfc='none', mec='cyan', mew=1.0, linestyle='none', transform=axtrans))
+
+    # provisional matches (prematch.py) open at the component phase with the
+    # hosts already marked, so enter confirms; a restart (r/b) starts from scratch
+    if xmatch.flag[target_index] == auto_flag and preselected_row != target_index:
+        preselect_auto()
+
+    if first_show:
+        # Start canvas listeners, these live as long as the window
+        keyID = fig.canvas.mpl_connect('key_press_event', on_key)
+        clickID = fig.canvas.mpl_connect('pick_event', onpick)
+
+        plt.subplots_adjust(left=0.05, right=0.9, top=0.9, bottom=0.1)
+        plt.get_current_fig_manager().window.wm_geometry(f"+{figure_pos_horizontal}+{figure_pos_vertical}")
+    else:
+        fig.canvas.draw_idle()
 
 
 # ------------------------------------------ #
@@ -714,11 +843,12 @@ def start():
 # Initial setup
 # ------------------------------------------ #	
 
-from astropy.io import ascii, fits
+from astropy.io import ascii
 from astropy.table import Column
-from astropy.coordinates import SkyCoord
-from astropy import units as u
+import catalogue
 import cutout as cutout
+import session
+from identity import CrossMatch, Identity, auto_flag
 import os
 import json
 
@@ -734,15 +864,13 @@ else:
 # ------------------------------------------ #	
 # Read in required file paths from config file
 
-with open(os.path.join(thisdir, 'path_config.json'), 'r') as config:
-    path_config = json.load(config)
-
 # field is specified in launch arguments
-radioSB = os.path.join(thisdir, path_config[field]["radio_continuum"])
-radioRMS = os.path.join(thisdir, path_config[field]["radio_rms"])
-mosaic = os.path.join(thisdir, path_config[field]["infrared_mosaic"])
-radio_catalogue = os.path.join(thisdir, path_config[field]["radio_catalog"])
-infrared_catalogue = os.path.join(thisdir, path_config[field]["infrared_catalog"])
+paths = field_paths(thisdir, field)
+radioSB = paths["radio_continuum"]
+radioRMS = paths["radio_rms"]
+mosaic = paths["infrared_mosaic"]
+radio_catalogue = paths["radio_catalog"]
+infrared_catalogue = paths["infrared_catalog"]
 output_name = f'{field}_mcvcm_table.dat'
 
 # output path for saved files
@@ -754,14 +882,37 @@ else:
 with open(os.path.join(thisdir, 'parameter_config.json'), 'r') as config:
     parameter_config = json.load(config)
 
+# every tag is written here as it is made, see update_table() for compaction
+store = session.open_store(parameter_config["session"]["backend"], os.path.splitext(save_path)[0],
+                           lease_minutes=parameter_config["session"]["lease_minutes"])
+lease_wait = 10  # seconds between retries when every source left is leased by another annotator
+
 figure_pos_horizontal = parameter_config["figure_position"]["horizontal"]
 figure_pos_vertical = parameter_config["figure_position"]["vertical"]
 
+# open the mosaics once, every cutout this session is served from these
+print(f'\nOpening mosaics for {field}')
+engine = cutout.CutoutEngine(mosaic, radioSB, radioRMS,
+                             vmax=parameter_config["image_scaling"]["max_saturation"],
+                             gamma=parameter_config["image_scaling"]["power_normalise"],
+                             rms_window=parameter_config['cutout_pixels']["radio"],
+                             verbose=verbose, timings=timings)
+prefetcher = cutout.CutoutPrefetcher(engine, depth=parameter_config["prefetch"]["depth"],
+                                     workers=parameter_config["prefetch"]["workers"])
+viewer = cutout.CutoutViewer(engine)
+
 ipix_default = parameter_config['cutout_pixels']["infrared"]
 rpix_default = parameter_config['cutout_pixels']["radio"]
 ipix_current, rpix_current = ipix_default, rpix_default  # sets the size (in pixels) of the slice
-start_index = parameter_config["start_index"]  # Change for manual inspection of catalogue sources
-target_index = start_index  # iterable used for rTable
+neighbour_radius = parameter_config["neighbour_radius_arcsec"]  # at the default cutout size
+confirm_auto = parameter_config["prematch"]["confirm"]  # show provisional matches, or skip them
+preselected_row = None  # last target whose provisional match was marked by preselect_auto()
+start_index = parameter_config["start_index"]  # catalogue row to start from, null for the head of target_order
+target_index = start_index or 0  # row of rTable being identified
+jump_row = None  # row asked for with 'G', served next by get_target()
+target_ordering = parameter_config["target_order"]  # name in session.orderings
+if target_ordering not in session.orderings:
+    raise Exception(f'target_order in parameter_config.json must be one of {tuple(session.orderings)}')
 
 # ------------------------------------------ #	
 # column names in catalogues
@@ -771,38 +922,60 @@ rID_column = parameter_config['column_names']['radio_id']
 iRA_column = parameter_config['column_names']['infrared_ra']
 iDEC_column = parameter_config['column_names']['infrared_dec']
 iID_column = parameter_config['column_names']['infrared_id']
+iDisplay_columns = parameter_config['infrared_display_columns']  # printed when a host is picked
 
 # ------------------------------------------ #	
-# set up catalogues, and add XID column
-tag_placeholder = '-' * 53  # placeholder needs to be same length as MAX final ^XID_tag, otherwise XID_tag is truncated
-comment_placeholder = '-' * 53
-skipped_placeholder = '---crossmatch_skipped-redo_by_running_with_-x_flag---'
+# set up catalogues, and the cross-match of each radio row
 
+# parsed once, later start-ups read the binary cache kept next to each catalogue
 print(f'\nReading radio table: {radio_catalogue}')
-rTable = ascii.read(radio_catalogue)
-rTable.add_column(Column([tag_placeholder, ] * len(rTable), name='mcvcm_tag'))
-rTable.add_column(Column([comment_placeholder, ] * len(rTable), name='mcvcm_comment'))
-rTable.add_column(Column([0, ] * len(rTable), name='mcvcm_flag'))
+with timings('catalogue load'):
+    rTable, rXYZ = catalogue.load_radio(radio_catalogue, rRA_column, rDEC_column, progress=True)
 
 print(f'\nReading infrared table: {infrared_catalogue}')
-iTable = fits.open(infrared_catalogue)[1].data
+with timings('catalogue load'):
+    iTable, iXYZ = catalogue.load_infrared(infrared_catalogue,
+                                           [iID_column, iRA_column, iDEC_column] + iDisplay_columns,
+                                           iRA_column, iDEC_column, progress=True)
+
+# integer rows, the xid tag columns are only written out when saving (see session.xid_table)
+xmatch = CrossMatch(rTable[rID_column], iTable[iID_column])
 
 # ------------------------------------------ #
-# generate coordinate lookup array
-iCoords = SkyCoord(np.array(iTable[iRA_column]), np.array(iTable[iDEC_column]), frame='fk5', unit='deg')
-rCoords = SkyCoord(np.array(rTable[rRA_column]), np.array(rTable[rDEC_column]), frame='fk5', unit='deg')
+# generate spatial indices for neighbourhood look-ups
+with timings('coordinate build'):
+    iIndex = catalogue.SkyIndex(None, None, xyz=iXYZ)
+    rIndex = catalogue.SkyIndex(None, None, xyz=rXYZ)
+
+# friends-of-friends groups of radio components (target_order "group" serves a group at a time)
+with timings('grouping'):
+    rTable.add_column(Column(catalogue.friends_of_friends(rIndex, parameter_config['grouping']['linking_arcsec']),
+                             name='mcvcm_group'))
+    group_order = np.argsort(np.asarray(rTable['mcvcm_group']), kind='stable')  # rows, group by group
+    ordered_groups = np.asarray(rTable['mcvcm_group'])[group_order]
 
 
 # execute
 if __name__ == '__main__':
     check_save()
+    build_queue()
 
     quitting = False
-    newtarget = rTable['mcvcm_tag'][
-                    start_index] != tag_placeholder  # new target starts true only if already ID first source
-
-    while not quitting:
-        get_target()
-        start()
-
+    newtarget = True  # get_target() starts its search at the head of the queue, and leases the row it settles on
+
+    # one window for the whole session, key presses move it from source to source
+    next_source()
+    if not quitting:
+        plt.show()
+
+    prefetcher.shutdown()
+    store.close()
+
+    if timeon:
+        timings.report()
+        output = 'demo_output' if doing_demo else 'output'
+        prefix = 'demo-' if doing_demo else ''
+        timing_path = os.path.join(make_folder(os.path.join(thisdir, output, 'timings')),
+                                   f'{prefix}{field}_timings_{time.strftime("%Y%m%d-%H%M%S")}')
+        print('Timings written to', *timings.write(timing_path))
     print('Quitting')
\ No newline at end of file
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# prematch.py
+#
+# Automatic cross-matching of the unambiguous sources of a field, before
+# the interactive session.
+#
+# A radio source with no other radio source within the isolation radius,
+# and exactly one infrared source within the match radius, is given a
+# provisional single-component tag (the same format as mcvcm.py makes)
+# with mcvcm_flag = identity.auto_flag. Sources that are already tagged
+# are left alone. Tags go to the session journal/database, so the next
+# mcvcm.py session picks them up and skips these sources, or shows them
+# for confirmation if "confirm" is set in parameter_config.json, e.g.:
+#
+#   >> prematch.py ELAIS --radius 2 --isolation 30
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import argparse
+import os
+
+from utilities import field_paths, make_folder, read_config
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    field_choices = tuple(read_config(thisdir, 'path_config.json').keys())
+    parameter_config = read_config(thisdir, 'parameter_config.json')
+    defaults = parameter_config['prematch']
+
+    parser = argparse.ArgumentParser(description='Provisionally cross-matches the unambiguous sources of a field')
+    parser.add_argument('field', choices=field_choices, help=f'specify the field to prematch: {field_choices}')
+    parser.add_argument('--radius', type=float, default=defaults['radius_arcsec'],
+                        help=f'infrared match radius in arcsec (default {defaults["radius_arcsec"]})')
+    parser.add_argument('--isolation', type=float, default=defaults['isolation_arcsec'],
+                        help=f'no other radio source within this many arcsec (default {defaults["isolation_arcsec"]})')
+    parser.add_argument('--dry-run', action='store_true', default=False, help='count the matches, write nothing')
+    parser.add_argument('-d', help='prematch the demo session', action='store_true', default=False)
+    args = parser.parse_args()
+
+    import numpy as np
+
+    import catalogue
+    import session
+    from identity import CrossMatch, auto_flag, untagged_row
+
+    columns = parameter_config['column_names']
+    paths = field_paths(thisdir, args.field)
+    output = 'demo_output' if args.d else 'output'
+    prefix = 'demo-' if args.d else ''
+    save_path = os.path.join(make_folder(os.path.join(thisdir, output, 'tables')),
+                             f'{prefix}{args.field}_mcvcm_table.dat')
+
+    print(f'Reading radio table: {paths["radio_catalog"]}')
+    rTable, rXYZ = catalogue.load_radio(paths['radio_catalog'], columns['radio_ra'], columns['radio_dec'],
+                                        progress=True)
+    print(f'Reading infrared table: {paths["infrared_catalog"]}')
+    iTable, iXYZ = catalogue.load_infrared(paths['infrared_catalog'],
+                                           [columns['infrared_id'], columns['infrared_ra'], columns['infrared_dec']],
+                                           columns['infrared_ra'], columns['infrared_dec'], progress=True)
+    xmatch = CrossMatch(rTable[columns['radio_id']], iTable[columns['infrared_id']])
+
+    # never overwrite a tag that already exists, by hand or from an earlier run
+    store = session.open_store(parameter_config['session']['backend'], os.path.splitext(save_path)[0],
+                               lease_minutes=parameter_config['session']['lease_minutes'])
+    seeded = False
+    if store.exists():
+        session.apply_records(xmatch, store.replay())
+    elif os.path.isfile(save_path):
+        from astropy.io import ascii
+        session.merge_saved(xmatch, ascii.read(save_path), columns['radio_id'])
+        seeded = True
+
+    rows, hosts = catalogue.unambiguous_matches(catalogue.SkyIndex(None, None, xyz=rXYZ),
+                                                catalogue.SkyIndex(None, None, xyz=iXYZ),
+                                                args.radius, args.isolation)
+    untagged = xmatch.core == untagged_row
+    keep = untagged[rows]
+    rows, hosts = rows[keep], hosts[keep]
+    print(f'{len(rows)} of {np.count_nonzero(untagged)} untagged radio sources have an unambiguous match '
+          f'(one infrared source within {args.radius}", no radio source within {args.isolation}")')
+
+    if not args.dry_run and len(rows):
+        # single-component sources, each its own radio core
+        xmatch.set(rows, rows, hosts, 1, 0, auto_flag)
+        if seeded:
+            # mcvcm.py replays the store in preference to the table, so a new
+            # store is given the table's tags too, as check_save() does
+            rows = np.flatnonzero(xmatch.recorded())
+        store.append(session.table_records(xmatch, rows))
+        print(f'Provisional tags written to {store.path}')
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# preprocess.py
+#
+# One-off, per-field preparation of the mosaics in path_config.json
+# so that mcvcm.py (and render.py) make cutouts faster:
+#
+#   --tile      rewrite each mosaic as contiguous square tiles, so a
+#               cutout reads a few tiles instead of hundreds of strided rows
+#   --reproject reproject the whole radio map onto the infrared mosaic's
+#               pixel grid, so a cutout needs no per-source reprojection
+#   --rms-grid  precompute the local median RMS on a coarse grid, so
+#               contour levels are a lookup instead of a median per cutout
+#
+# The results are written next to the mosaics, and are ignored (and
+# should be re-made) once a mosaic changes, e.g.:
+#
+#   >> preprocess.py ELAIS --tile --reproject --rms-grid
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import argparse
+import os
+
+from utilities import field_paths, read_config
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+mosaic_keys = ('infrared_mosaic', 'radio_continuum', 'radio_rms')
+
+
+def tile_field(paths, tile, force=False):
+    import cutout
+
+    for key in mosaic_keys:
+        index_path = cutout.tile_paths(paths[key])[1]
+        if not force and cutout.is_fresh(index_path, paths[key]):
+            print(f'{key}: tiles are up to date ({index_path})')
+            continue
+        print(f'{key}: tiling {paths[key]} ({tile}x{tile} pixels)')
+        cutout.write_tiles(paths[key], tile=tile, verbose=True)
+
+
+def reproject_field(paths, strip, workers, force=False):
+    import cutout
+
+    index_path = cutout.projected_paths(paths['radio_continuum'], paths['infrared_mosaic'])[1]
+    if not force and cutout.is_fresh(index_path, paths['radio_continuum'], paths['infrared_mosaic']):
+        print(f'reprojected radio is up to date ({index_path})')
+        return
+    print(f'reprojecting {paths["radio_continuum"]} onto {paths["infrared_mosaic"]}')
+    cutout.write_projected(paths['radio_continuum'], paths['infrared_mosaic'], strip=strip, workers=workers,
+                           verbose=True)
+
+
+def rms_grid_field(paths, window, step, force=False):
+    import cutout
+
+    index_path = cutout.rms_grid_paths(paths['radio_rms'])[1]
+    if not force and cutout.is_fresh(index_path, paths['radio_rms'], window=window):
+        print(f'rms grid is up to date ({index_path})')
+        return
+    print(f'computing local rms of {paths["radio_rms"]} ({window} pixel window every {step} pixels)')
+    cutout.write_rms_grid(paths['radio_rms'], window, step=step, verbose=True)
+
+
+def main():
+    field_choices = tuple(read_config(thisdir, 'path_config.json').keys())
+
+    parser = argparse.ArgumentParser(description='Prepares the mosaics of a field for fast cutouts')
+    parser.add_argument('field', choices=field_choices, help=f'specify the field to prepare from: {field_choices}')
+    parser.add_argument('--tile', action='store_true', default=False,
+                        help='write tiled copies of the mosaics for random-access cutouts')
+    parser.add_argument('--tile-size', type=int, default=256, help='tile width in pixels (default 256)')
+    parser.add_argument('--reproject', action='store_true', default=False,
+                        help='reproject the radio map onto the infrared grid once for the whole field')
+    parser.add_argument('--strip', type=int, default=512, help='rows of the infrared grid per reprojection job')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--rms-grid', action='store_true', default=False,
+                        help='precompute local median rms for the contour levels')
+    parser.add_argument('--grid-step', type=int, default=32, help='rms grid spacing in radio pixels (default 32)')
+    parser.add_argument('--force', action='store_true', default=False, help='redo steps that are already up to date')
+    args = parser.parse_args()
+
+    paths = field_paths(thisdir, args.field)
+    if not (args.tile or args.reproject or args.rms_grid):
+        parser.error('nothing to do, choose at least one step (e.g. --tile)')
+    if args.tile:
+        tile_field(paths, args.tile_size, force=args.force)
+    if args.reproject:
+        reproject_field(paths, args.strip, args.workers, force=args.force)
+    if args.rms_grid:
+        window = read_config(thisdir, 'parameter_config.json')['cutout_pixels']['radio']
+        rms_grid_field(paths, window, args.grid_step, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# render.py
+#
+# Headless batch rendering of MCVCM cutout figures.
+#
+# Draws every cross-matched source of a field (or every radio source with
+# --all) the way mcvcm.py shows it once identified: infrared heatmap, radio
+# contours, infrared host crosshair, radio core and component markers.
+# Tags are read from the session journal/database or a saved mcvcm table.
+#
+# Work is spread over a process pool, each worker opening its own
+# memory-mapped CutoutEngine, e.g.:
+#
+#   >> render.py ELAIS --format png --workers 8
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import argparse
+import os
+
+import matplotlib
+
+matplotlib.use("Agg")  # no window, safe in worker processes
+
+import numpy as np
+
+from utilities import field_paths, make_folder, read_config, Crosshair
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+
+_engine = None  # per worker process, see _init_worker()
+
+
+def _init_worker(paths, scaling, rsize):
+    global _engine
+    import cutout
+    _engine = cutout.CutoutEngine(paths['infrared_mosaic'], paths['radio_continuum'], paths['radio_rms'],
+                                  vmax=scaling['max_saturation'], gamma=scaling['power_normalise'], rms_window=rsize)
+
+
+def _render(job):
+    '''
+        Draws and saves one source, job is a dict made by make_jobs()
+    '''
+    import matplotlib.pyplot as plt
+
+    fig, ax, axtrans, wcsmap = _engine.cutouts2(job['ra'], job['dec'], isize=job['isize'], rsize=job['rsize'])
+
+    if job['inf_host'] is not None:
+        xpix, ypix = wcsmap.wcs_world2pix([job['inf_host']], 1)[0]
+        Crosshair(xpix, ypix, ax, linewidth=1.5)
+    if job['rad_host'] is not None:
+        ax.plot(*job['rad_host'], 'D', markersize=16, mfc='none', mec='green', mew=1.2, transform=axtrans)
+    for label, (cra, cdec) in job['components']:
+        ax.text(cra, cdec, ' - %s' % label, horizontalalignment='left', transform=axtrans, clip_on=True)
+        ax.plot(cra, cdec, 's', markersize=16, mfc='none', mec='limegreen', mew=1.2, transform=axtrans)
+
+    for filename in job['filenames']:
+        fig.savefig(filename, bbox_inches='tight', dpi=300)
+    plt.close(fig)
+    return job['title']
+
+
+def make_jobs(rTable, iTable, xmatch, columns, isize, rsize, fig_path, extensions, everything=False):
+    '''
+        One job per cross-matched source (rows sharing radio and
+        infrared host), plus one per untagged row if everything is set
+    '''
+    tagged = np.flatnonzero(xmatch.tagged())
+    core_rows, host_rows, component = xmatch.core[tagged], xmatch.host[tagged], xmatch.comp[tagged]
+
+    rRA, rDEC = np.asarray(rTable[columns['radio_ra']]), np.asarray(rTable[columns['radio_dec']])
+    rIDs = np.asarray(rTable[columns['radio_id']]).astype(str)
+
+    jobs = []
+    # tags naming sources missing from the catalogues are drawn on their own row
+    source = np.where(core_rows >= 0, core_rows, tagged).astype(np.int64) * (len(iTable) + 1) + host_rows + 1
+    keys, group, counts = np.unique(source, return_inverse=True, return_counts=True)
+    for members in np.split(np.argsort(group, kind='stable'), np.cumsum(counts)[:-1]):
+        core = core_rows[members[0]]
+        host = host_rows[members[0]]
+        centre = core if core >= 0 else tagged[members[0]]
+        comps = [(f'C{component[m]}', (rRA[tagged[m]], rDEC[tagged[m]])) for m in members if component[m] > 0]
+        jobs.append({'title': rIDs[centre], 'ra': rRA[centre], 'dec': rDEC[centre], 'isize': isize, 'rsize': rsize,
+                     'rad_host': (rRA[core], rDEC[core]) if core >= 0 else None,
+                     'inf_host': (iTable[columns['infrared_ra']][host], iTable[columns['infrared_dec']][host])
+                     if host >= 0 else None,
+                     'components': comps,
+                     'filenames': [os.path.join(fig_path, f'{rIDs[centre]}.{ext}') for ext in extensions]})
+
+    if everything:
+        done = np.zeros(len(rTable), dtype=bool)
+        done[tagged] = True
+        for row in np.flatnonzero(~done):
+            jobs.append({'title': rIDs[row], 'ra': rRA[row], 'dec': rDEC[row], 'isize': isize, 'rsize': rsize,
+                         'rad_host': None, 'inf_host': None, 'components': [],
+                         'filenames': [os.path.join(fig_path, f'{rIDs[row]}.{ext}') for ext in extensions]})
+    return jobs
+
+
+def main():
+    path_config = read_config(thisdir, 'path_config.json')
+    field_choices = tuple(path_config.keys())
+
+    parser = argparse.ArgumentParser(description='Renders MCVCM cutout figures for a whole field, without a window')
+    parser.add_argument('field', choices=field_choices, help=f'specify the field to render from: {field_choices}')
+    parser.add_argument('--format', dest='formats', nargs='+', default=['png'], choices=['png', 'pdf', 'eps'],
+                        help='figure format(s) to write (default png)')
+    parser.add_argument('--all', dest='everything', action='store_true', default=False,
+                        help='also render radio sources without a cross-match')
+    parser.add_argument('--table', default=None, help='read tags from this saved mcvcm table instead')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('-d', help='render the demo session', action='store_true', default=False)
+    args = parser.parse_args()
+
+    from concurrent.futures import ProcessPoolExecutor
+    import catalogue
+    import session
+    from identity import CrossMatch
+
+    parameter_config = read_config(thisdir, 'parameter_config.json')
+    columns = parameter_config['column_names']
+    paths = field_paths(thisdir, args.field)
+
+    output = 'demo_output' if args.d else 'output'
+    prefix = 'demo-' if args.d else ''
+    save_path = os.path.join(thisdir, output, 'tables', f'{prefix}{args.field}_mcvcm_table.dat')
+    fig_path = make_folder(os.path.join(thisdir, output, 'figures', f'{args.field}_render'))
+
+    print(f'Reading radio table: {paths["radio_catalog"]}')
+    rTable, _ = catalogue.load_radio(paths['radio_catalog'], columns['radio_ra'], columns['radio_dec'])
+
+    print(f'Reading infrared table: {paths["infrared_catalog"]}')
+    iTable, _ = catalogue.load_infrared(paths['infrared_catalog'],
+                                        [columns[name] for name in ('infrared_id', 'infrared_ra', 'infrared_dec')],
+                                        columns['infrared_ra'], columns['infrared_dec'])
+
+    xmatch = CrossMatch(rTable[columns['radio_id']], iTable[columns['infrared_id']])
+    session.load_tags(xmatch, columns['radio_id'], save_path, parameter_config['session']['backend'], table=args.table)
+
+    jobs = make_jobs(rTable, iTable, xmatch, columns, parameter_config['cutout_pixels']['infrared'],
+                     parameter_config['cutout_pixels']['radio'], fig_path, args.formats, everything=args.everything)
+    print(f'Rendering {len(jobs)} figures to {fig_path} on {args.workers} workers')
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(paths, parameter_config['image_scaling'],
+                                       parameter_config['cutout_pixels']['radio'])) as pool:
+        for done, name in enumerate(pool.map(_render, jobs, chunksize=8), 1):
+            if not done % 100 or done == len(jobs):
+                print(f'{done}/{len(jobs)} rendered (last: {name})')
+
+
+if __name__ == '__main__':
+    main()
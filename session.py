@@ -0,0 +1,558 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# session.py
+#
+# Saving and recovering cross-match progress for mcvcm.py,
+# and the queue of sources still to be cross-matched
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import itertools
+import json
+import os
+
+import numpy as np
+
+from utilities import version_control
+
+xid_columns = ('mcvcm_tag', 'mcvcm_flag', 'mcvcm_comment')
+
+
+def lookup_rows(keys, values, order=None):
+    '''
+        Sorted-key join: finds the row of each of values in keys,
+        order is the argsort of keys if already known
+
+        Returns an integer array the length of values,
+        holding -1 wherever a value isn't in keys
+    '''
+    keys = np.asarray(keys, dtype=str)
+    values = np.asarray(values).astype(str)
+    if len(keys) == 0:
+        return np.full(len(values), -1, dtype=int)
+
+    if order is None:
+        order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    pos = np.searchsorted(sorted_keys, values)
+    pos[pos == len(keys)] = 0
+    return np.where(sorted_keys[pos] == values, order[pos], -1)
+
+
+def _filled(column):
+    ''' replaces masked (empty) entries read from file '''
+    if hasattr(column, 'filled'):
+        return column.filled('' if column.dtype.kind in 'US' else 0)
+    return column
+
+
+def merge_saved(xmatch, saved_table, id_column):
+    '''
+        Reads the xid columns of a previous session's table into
+        the matching rows (by id_column) of xmatch, in bulk.
+
+        Returns the number of rows recovered, and the IDs in
+        saved_table that are missing from the radio catalogue
+    '''
+    rows = xmatch.rows(saved_table[id_column])
+    found = rows >= 0
+
+    tag, flag, comment = (np.asarray(_filled(saved_table[name]))[found] for name in xid_columns)
+    xmatch.set_tags(rows[found], tag, flag, comment)
+
+    missing = np.asarray(saved_table[id_column])[~found]
+    return int(found.sum()), missing
+
+
+def table_records(xmatch, rows):
+    '''
+        The xid columns of the given rows as journal records
+    '''
+    rows = np.asarray(rows, dtype=int)
+    ids = np.asarray(xmatch.rad_ids)[rows].astype(str)
+    tags, comments = xmatch.tags(rows), xmatch.comments(rows)
+    return [{'id': source, 'mcvcm_tag': tag, 'mcvcm_flag': flag, 'mcvcm_comment': comment}
+            for source, tag, flag, comment in zip(ids.tolist(), tags.tolist(), xmatch.flag[rows].tolist(),
+                                                  comments.tolist())]
+
+
+def apply_records(xmatch, records):
+    '''
+        Reads journal records into the matching rows (by ID) of
+        xmatch. Later records for the same ID win.
+
+        Returns the number of records applied and the IDs missing from the catalogue
+    '''
+    if not records:
+        return 0, np.array([], dtype=str)
+
+    ids = [record['id'] for record in records]
+    rows = xmatch.rows(ids)
+    found = np.flatnonzero(rows >= 0)
+
+    tag, flag, comment = ([records[i][name] for i in found] for name in xid_columns)
+    xmatch.set_tags(rows[found], tag, flag, comment)
+
+    missing = np.asarray(ids)[rows < 0]
+    return len(found), missing
+
+
+def xid_table(table, xmatch, rows=slice(None)):
+    '''
+        rows of table with the xid columns written out
+        from xmatch, ready for write_table()
+    '''
+    from astropy.table import Column
+
+    rows = np.arange(len(table))[rows]
+    out = table[rows]
+    out.add_column(Column(xmatch.tags(rows), name='mcvcm_tag'))
+    out.add_column(Column(xmatch.comments(rows), name='mcvcm_comment'))
+    out.add_column(Column(xmatch.flag[rows].astype(int), name='mcvcm_flag'))
+    return out
+
+
+def load_tags(xmatch, rID_column, save_path, backend, table=None):
+    '''
+        Fills xmatch from a saved table (if given),
+        otherwise from the session store or master table at save_path
+    '''
+    from astropy.io import ascii
+
+    if table is not None:
+        count, missing = merge_saved(xmatch, ascii.read(table), rID_column)
+    else:
+        store = open_store(backend, os.path.splitext(save_path)[0])
+        if store.exists():
+            count, missing = apply_records(xmatch, store.replay())
+        elif os.path.isfile(save_path):
+            count, missing = merge_saved(xmatch, ascii.read(save_path), rID_column)
+        else:
+            count, missing = 0, []
+        store.close()
+    if len(missing):
+        print(f'WARNING: {len(missing)} saved IDs are not in the radio catalogue')
+    print(f'Read {count} tags')
+
+
+def write_table(table, path):
+    '''
+        Writes the fixed width table via a temporary file, so a crash
+        mid-write never leaves a half written copy at path
+    '''
+    from astropy.io import ascii
+
+    temp_path = path + '.tmp'
+    ascii.write(table, temp_path, format='fixed_width_two_line', overwrite=True)
+    with open(temp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class Journal(object):
+    '''
+        Append-only, crash-safe record of tagged rows.
+
+        Each tag written during a session is appended as one JSON
+        line and fsynced straight away, so saving costs the same at
+        the end of a field as at the start. compact() rewrites the
+        journal down to one record per row.
+
+        Example usage:
+
+        journal = Journal('output/tables/ELAIS_mcvcm_table.journal')
+        journal.append([{'id': 'EI1896', 'mcvcm_tag': ..., 'mcvcm_flag': 1, 'mcvcm_comment': ...}])
+        records = journal.replay()
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def backup(self):
+        version_control(self.path)
+
+    def append(self, records):
+        if self.file is None:
+            torn = self.exists() and os.path.getsize(self.path) and not self._ends_with_newline()
+            self.file = open(self.path, 'a')
+            if torn:  # don't extend a line left unfinished by a crash
+                self.file.write('\n')
+        for record in records:
+            self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _ends_with_newline(self):
+        with open(self.path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b'\n'
+
+    def replay(self):
+        '''
+            Returns the journal's records in the order written,
+            a torn final line (from a crash mid-write) is ignored
+        '''
+        records = []
+        if not self.exists():
+            return records
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f'WARNING: ignoring unreadable journal line in {self.path}: {line!r}')
+        return records
+
+    def compact(self, records):
+        '''
+            Replaces the journal with records (one per tagged row)
+        '''
+        self.close()
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def sync(self):
+        ''' a journal has a single writer, there is never anything new '''
+        return []
+
+    def lease(self, source):
+        return True
+
+    def release(self, source):
+        pass
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class SQLiteStore(object):
+    '''
+        SQLite session store, for several annotators working one field.
+
+        Has the same interface as Journal. Each append is one small
+        transaction, and targets are handed out through leases
+        (see lease()) so that several mcvcm.py processes on one
+        machine never work the same source at once. sync() returns
+        the records written by other processes since the last call.
+
+        Example usage:
+
+        store = SQLiteStore('output/tables/ELAIS_mcvcm_table.sqlite', lease_minutes=30)
+        if store.lease('EI1896'):
+            ...
+            store.append(records)  # also releases the leases on those IDs
+    '''
+
+    def __init__(self, path, lease_minutes=30):
+        import socket
+        import sqlite3
+
+        self.path = path
+        self.lease_seconds = 60 * lease_minutes
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.version = 0  # last version seen by sync()
+
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tags (id TEXT PRIMARY KEY, mcvcm_tag TEXT, mcvcm_flag INTEGER, '
+                        'mcvcm_comment TEXT, owner TEXT, version INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS leases (id TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+    def exists(self):
+        return self.db.execute('SELECT COUNT(*) FROM tags').fetchone()[0] > 0
+
+    def backup(self):
+        import sqlite3
+
+        def copy(source, destination):
+            target = sqlite3.connect(destination)
+            self.db.backup(target)
+            target.close()
+
+        version_control(self.path, copy=copy)
+
+    def append(self, records):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.db.execute('SELECT COALESCE(MAX(version), 0) FROM tags').fetchone()[0]
+            for record in records:
+                version += 1
+                self.db.execute('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?)',
+                                (record['id'], record['mcvcm_tag'], record['mcvcm_flag'], record['mcvcm_comment'],
+                                 self.owner, version))
+            self.db.executemany('DELETE FROM leases WHERE id = ? AND owner = ?',
+                                [(record['id'], self.owner) for record in records])
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def _records(self, query, parameters=()):
+        records = []
+        for source, tag, flag, comment, version in self.db.execute(query, parameters):
+            records.append({'id': source, 'mcvcm_tag': tag, 'mcvcm_flag': flag, 'mcvcm_comment': comment})
+            self.version = max(self.version, version)
+        return records
+
+    def replay(self):
+        return self._records('SELECT id, mcvcm_tag, mcvcm_flag, mcvcm_comment, version FROM tags ORDER BY version')
+
+    def sync(self):
+        return self._records('SELECT id, mcvcm_tag, mcvcm_flag, mcvcm_comment, version FROM tags '
+                             'WHERE version > ? AND owner != ? ORDER BY version', (self.version, self.owner))
+
+    def compact(self, records):
+        '''
+            Nothing to compact, every row was committed by append(). Rewriting
+            them here would overwrite newer tags from other processes
+        '''
+        pass
+
+    def lease(self, source):
+        '''
+            Claims source for this process, returns False if
+            another process holds an unexpired lease on it
+        '''
+        import time
+
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute('DELETE FROM leases WHERE expires < ?', (now,))
+            holder = self.db.execute('SELECT owner FROM leases WHERE id = ?', (source,)).fetchone()
+            leased = holder is None or holder[0] == self.owner
+            if leased:
+                self.db.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)',
+                                (source, self.owner, now + self.lease_seconds))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return leased
+
+    def release(self, source):
+        self.db.execute('DELETE FROM leases WHERE id = ? AND owner = ?', (source, self.owner))
+
+    def close(self):
+        if self.db is not None:
+            self.db.execute('DELETE FROM leases WHERE owner = ?', (self.owner,))
+            self.db.close()
+            self.db = None
+
+
+def open_store(backend, path, lease_minutes=30):
+    '''
+        Returns the session store for backend ('journal' or 'sqlite'),
+        path is given without extension
+    '''
+    if backend == 'sqlite':
+        return SQLiteStore(path + '.sqlite', lease_minutes=lease_minutes)
+    elif backend == 'journal':
+        return Journal(path + '.journal')
+    raise ValueError(f'unknown session backend <{backend}>, use \'journal\' or \'sqlite\'')
+
+
+# ------------------------------------------ #
+# status of each radio row, kept alongside the table by TargetQueue
+untagged, tagged, skipped, auto = range(4)
+status_names = ('untagged', 'tagged', 'skipped', 'auto')
+
+
+def match_status(xmatch, rows=slice(None)):
+    '''
+        Status of rows from their cross-match, all at once
+    '''
+    from identity import auto_flag, skipped_row
+
+    core, flag = xmatch.core[rows], xmatch.flag[rows]
+    status = np.where(xmatch.tagged()[rows], tagged, untagged).astype(np.int8)
+    status[core == skipped_row] = skipped
+    status[(status == tagged) & (flag == auto_flag)] = auto
+    return status
+
+
+def curve_order(table, columns, curve='hilbert'):
+    '''
+        Rows along a space-filling curve over the sky, so consecutive
+        targets share mosaic pages, tiles and neighbours. Each
+        friends-of-friends group is placed at its first row and kept together.
+    '''
+    from catalogue import curve_keys
+
+    rows = np.arange(len(table))
+    group = np.asarray(table['mcvcm_group']) if 'mcvcm_group' in table.colnames else rows
+    ra, dec = np.asarray(table[columns['radio_ra']]), np.asarray(table[columns['radio_dec']])
+    keys = curve_keys(ra[group], dec[group], curve=curve)
+    return np.lexsort((rows, group, keys))
+
+
+# orderings targets can be served in, name: function(table, column_names) returning
+# every row once; add to this dict for other orderings (e.g. by flux)
+orderings = {
+    'catalogue': lambda table, columns: np.arange(len(table)),
+    'group': lambda table, columns: np.argsort(np.asarray(table['mcvcm_group']), kind='stable'),
+    'hilbert': lambda table, columns: curve_order(table, columns, 'hilbert'),
+    'morton': lambda table, columns: curve_order(table, columns, 'morton'),
+}
+
+
+def stored_order(path, name, table, columns, catalogue_path, **settings):
+    '''
+        The ordering name of table, saved to path.order.npy on first use and
+        read back by later sessions, so resuming serves targets in the same
+        order. It is remade if the catalogue, ordering or settings change.
+    '''
+    from utilities import is_fresh, source_stamp
+
+    order_path, index_path = path + '.order.npy', path + '.order.json'
+    if is_fresh(index_path, catalogue_path, ordering=name, settings=settings):
+        return np.load(order_path)
+
+    order = np.asarray(orderings[name](table, columns), dtype=int)
+    if os.path.isfile(index_path):
+        print(f'Catalogue or target_order settings have changed, remaking the {name} order of targets')
+    np.save(order_path, order)
+    index = {'ordering': name, 'settings': settings}
+    index.update(source_stamp(catalogue_path))
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    return order
+
+
+class TargetQueue(object):
+    '''
+        The rows still to be cross-matched, in serving order.
+
+        status holds the status of every row (see match_status), rows with
+        a status in pending are queued. The queue is built all at once,
+        next() is O(1) (rows tagged since are dropped as they're reached),
+        and jump() moves to any row in O(log n). The queue wraps around,
+        so rows passed over by a jump() are served once the end is reached.
+
+        Example usage:
+
+        queue = TargetQueue(order, match_status(xmatch))
+        row = queue.current()          # next pending row, None once nothing is pending
+        queue.set_status([row], tagged)
+        row = queue.next()
+        row, held = queue.serve(lease)  # first pending row lease(row) grants
+    '''
+
+    def __init__(self, order, status, pending=(untagged,)):
+        self.order = np.asarray(order, dtype=int)
+        self.rank = np.empty(len(self.order), dtype=int)  # position of each row in order
+        self.rank[self.order] = np.arange(len(self.order))
+        self.status = status
+        self.pending = np.zeros(len(status_names), dtype=bool)
+        self.pending[list(pending)] = True
+        self.deferred = np.zeros(len(self.order), dtype=bool)  # out of the queue whatever their status
+        self.position = 0  # rank of the current row
+        self.rebuild()
+
+    def rebuild(self):
+        '''
+            Requeues every pending row, e.g. after many statuses changed at once
+        '''
+        self.queue = self.order[self.pending[self.status[self.order]] & ~self.deferred[self.order]]
+        self.queue_ranks = self.rank[self.queue]
+        self.head = int(np.searchsorted(self.queue_ranks, self.position))
+
+    def __len__(self):
+        return int(np.count_nonzero(self.pending[self.status] & ~self.deferred))
+
+    def is_pending(self, row):
+        return bool(self.pending[self.status[row]]) and not self.deferred[row]
+
+    def defer(self, rows):
+        ''' takes rows out of the queue for the rest of the session, e.g. skipped again with -x '''
+        self.deferred[rows] = True
+
+    def set_status(self, rows, status):
+        self.status[rows] = status
+
+    def current(self):
+        '''
+            The first pending row at or after the current position,
+            wrapping around to the start of the order; None if no row is pending
+        '''
+        for wrapped in (False, True):
+            while self.head < len(self.queue) and not self.is_pending(self.queue[self.head]):
+                self.head += 1
+            if self.head < len(self.queue):
+                self.position = int(self.rank[self.queue[self.head]])
+                return int(self.queue[self.head])
+            if not wrapped:
+                self.position = 0
+                self.rebuild()
+        return None
+
+    def next(self):
+        '''
+            Moves past the current row, returns the next pending row
+        '''
+        if self.head < len(self.queue) and self.queue_ranks[self.head] == self.position:
+            self.head += 1
+        return self.current()
+
+    def serve(self, lease):
+        '''
+            The first pending row, from the current one on, that lease(row)
+            grants. Returns (row, False), (None, False) if no row is pending,
+            or (None, True) if every pending row was refused (held by other
+            annotators), stopping back at the first refused row
+        '''
+        refused = None
+        row = self.current()
+        while row is not None:
+            if lease(row):
+                return row, False
+            if refused is None:
+                refused = row
+            row = self.next()
+            if row == refused:
+                return None, True
+        return None, False
+
+    def jump(self, row):
+        '''
+            Moves to row (pending or not), the queue carries on from there
+        '''
+        self.position = int(self.rank[row])
+        self.head = int(np.searchsorted(self.queue_ranks, self.position))
+
+    def upcoming(self, count):
+        '''
+            The next count pending rows after the current one, wrapping
+            around as current() does
+        '''
+        rows = []
+        start = int(np.searchsorted(self.queue_ranks, self.position, 'right'))
+        for head in itertools.chain(range(start, len(self.queue)), range(start)):
+            if len(rows) == count:
+                break
+            row = int(self.queue[head])
+            if self.is_pending(row) and self.rank[row] != self.position:
+                rows.append(row)
+        return rows
+
+    def find(self, key, xmatch):
+        '''
+            Row of a source given its ID (looked up in xmatch's
+            sorted IDs), or its row number as a string; None if neither
+        '''
+        row = xmatch.rows([key])[0]
+        if row >= 0:
+            return int(row)
+        if key.strip().isdigit() and int(key) < len(self.order):
+            return int(key)
+        return None
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# test_session.py
+#
+# Checks of the target queue in session.py, run with:
+#
+#   >> python -m pytest test_session.py
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+import numpy as np
+
+import session
+
+
+def make_queue(pending_rows, n=5):
+    status = np.full(n, session.tagged, dtype=np.int8)
+    status[pending_rows] = session.untagged
+    return session.TargetQueue(np.arange(n), status)
+
+
+def test_serve_stops_when_every_pending_row_is_leased():
+    queue = make_queue([2])
+    asked = []
+
+    def refuse(row):
+        asked.append(row)
+        return False
+
+    assert queue.serve(refuse) == (None, True)
+    assert asked == [2]
+    assert len(queue) == 1  # still pending, the session isn't done
+
+
+def test_serve_stops_after_one_pass_over_several_leased_rows():
+    queue = make_queue([0, 2, 4])
+    queue.jump(2)
+    asked = []
+
+    def refuse(row):
+        asked.append(row)
+        return False
+
+    assert queue.serve(refuse) == (None, True)
+    assert asked == [2, 4, 0]
+
+
+def test_serve_skips_leased_rows():
+    queue = make_queue([1, 3])
+    assert queue.serve(lambda row: row != 1) == (3, False)
+
+
+def test_serve_when_nothing_is_pending():
+    queue = make_queue([])
+    assert queue.serve(lambda row: True) == (None, False)
+
+
+def test_queue_wraps_after_a_jump():
+    queue = make_queue([0, 1, 3])
+    queue.jump(2)
+    served = []
+    row = queue.current()
+    while row is not None:
+        served.append(row)
+        queue.set_status([row], session.tagged)
+        row = queue.next()
+    assert served == [3, 0, 1]
@@ -2,8 +2,12 @@
 
 
 
+import json
 import os
 import shutil
+import time
+from contextlib import contextmanager
+from functools import wraps
 
 
 def print_center(*args):
@@ -18,6 +22,53 @@ def print_center(*args):
         print(arg.center(tcolumns))
 
 
+def read_config(thisdir, name):
+    '''
+        Reads one of the json configuration files, e.g.
+        read_config(thisdir, 'parameter_config.json')
+    '''
+    with open(os.path.join(thisdir, name), 'r') as config:
+        return json.load(config)
+
+
+def field_paths(thisdir, field):
+    '''
+        The data file paths of a field in path_config.json,
+        relative paths are taken from thisdir
+    '''
+    return {key: os.path.join(thisdir, path) for key, path in read_config(thisdir, 'path_config.json')[field].items()}
+
+
+def source_stamp(*paths):
+    '''
+        Size and modification time of the files something was made
+        from, stored alongside it so that stale copies can be detected
+    '''
+    stamps = []
+    for path in paths:
+        stat = os.stat(path)
+        stamps.append({'source': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime})
+    return {'sources': stamps}
+
+
+def is_fresh(index_path, *source_paths, **expected):
+    '''
+        True if the json index at index_path was made from source_paths
+        (same path, size and mtime) as they are now, and has the
+        expected values for any other keys given
+    '''
+    if not os.path.isfile(index_path):
+        return False
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    saved = index.get('sources', [])
+    current = source_stamp(*source_paths)['sources']
+    if any(index.get(key) != value for key, value in expected.items()):
+        return False
+    return len(saved) == len(current) and all(a['source'] == b['source'] and a['size'] == b['size'] and
+                                              a['mtime'] == b['mtime'] for a, b in zip(saved, current))
+
+
 # goo.gl/8jAuN5c
 def make_folder(path):
     ''' Makes folder if it doesn't exist '''
@@ -42,13 +93,16 @@ def file_accessible(filepath, mode='r'):
     return True
 
 
-def version_control(filename):
+def version_control(filename, copy=shutil.copy2):
     '''
         Primative version control:
 
         Checks for instance of a file,
         Creates numbered copy of that file,
         Numbers file appropriately if numbered file already exists
+
+        copy(source, destination) does the copying, e.g. for
+        files that can't safely be copied byte for byte
     '''
 
     path, exten = os.path.splitext(filename)
@@ -63,7 +117,103 @@ def version_control(filename):
         bkp_path = '{}-bkp-{:02d}'.format(path, bkp_int)
 
     print(f'Backing up file to: {bkp_path}{exten}')
-    shutil.copy2(filename, f'{bkp_path}{exten}')
+    copy(filename, f'{bkp_path}{exten}')
+
+
+class Timings(object):
+
+    '''
+        Per-stage wall-clock timings for a session (mcvcm.py -t)
+
+        Durations are measured with the monotonic time.perf_counter()
+        and kept per stage name, e.g.:
+
+            timings = Timings()
+            with timings('reprojection'):
+                <RUN CODE>
+
+            @timings.timed('pick')
+            def onpick(event): ...
+
+            timings.report()                 # percentiles to the terminal
+            timings.write('output/timings')  # .json and .csv
+
+        A disabled Timings records nothing and costs next to nothing,
+        so instrumented code doesn't need to check whether -t was given.
+    '''
+
+    # histogram bin edges in seconds, 0.1ms to 100s
+    bin_edges = [10 ** (x / 4) for x in range(-16, 9)]
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}  # name: list of seconds, appends are thread safe
+
+    @contextmanager
+    def __call__(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.setdefault(name, []).append(time.perf_counter() - start)
+
+    def timed(self, name):
+        ''' Decorator timing every call of a function as stage name '''
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self):
+        '''
+            {stage: {count, total, mean, p50, p90, p99, max, histogram}},
+            times in seconds, histogram counts per bin of bin_edges
+        '''
+        import numpy as np
+
+        summary = {}
+        for name, times in self.stages.items():
+            times = np.asarray(times)
+            p50, p90, p99 = np.percentile(times, [50, 90, 99])
+            summary[name] = {'count': len(times), 'total': times.sum(), 'mean': times.mean(),
+                             'p50': p50, 'p90': p90, 'p99': p99, 'max': times.max(),
+                             'histogram': np.histogram(times, bins=[0] + self.bin_edges + [np.inf])[0].tolist()}
+        return summary
+
+    def report(self):
+        ''' Prints a table of stage percentiles, in milliseconds '''
+        summary = self.summary()
+        width = max([len(name) + 2 for name in summary] + [24])
+        print(f'{"stage":<{width}}{"count":>8}{"total s":>10}{"mean":>9}{"p50":>9}{"p90":>9}{"p99":>9}{"max":>9}')
+        for name, s in sorted(summary.items(), key=lambda item: -item[1]['total']):
+            print(f'{name:<{width}}{s["count"]:>8}{s["total"]:>10.2f}' +
+                  ''.join(f'{1e3 * s[key]:>9.1f}' for key in ('mean', 'p50', 'p90', 'p99', 'max')))
+
+    def write(self, path):
+        '''
+            Writes the summary to path.json (with histograms)
+            and path.csv (one row per stage), returns both paths
+        '''
+        import csv
+
+        summary = self.summary()
+        with open(f'{path}.json', 'w') as f:
+            json.dump({'bin_edges': self.bin_edges,
+                       'stages': {name: {key: float(value) if key != 'histogram' else value
+                                         for key, value in s.items()} for name, s in summary.items()}}, f, indent=2)
+        columns = ('count', 'total', 'mean', 'p50', 'p90', 'p99', 'max')
+        with open(f'{path}.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('stage',) + columns)
+            for name, s in summary.items():
+                writer.writerow((name,) + tuple(s[key] for key in columns))
+        return f'{path}.json', f'{path}.csv'
 
 
 class Crosshair(object):